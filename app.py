@@ -1,27 +1,43 @@
 import os
 import uuid
-from flask import Flask, request, jsonify, Response
-from sqlalchemy import text
-from sqlalchemy.exc import OperationalError, DBAPIError
-from src.metrics import log_api_call_count, log_api_call_duration
-from src.models import db, User, Image
-from src.auth import token_required
-import bcrypt
+from flask import Flask, request, jsonify, Response, g
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.middleware.proxy_fix import ProxyFix
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError, DBAPIError, InterfaceError
+from src.metrics import (timed, start_request_metrics, set_request_status, finish_request_metrics,
+                         route_sample_rates, parse_sample_rates)
+from src.models import db, User, Image, EMAIL_REGEX
+from src.db_health import db_breaker
+from src.migrations import run_migrations
+from src.reaper import reap_expired_users
+from src.profiler import profiler
+from src.log_pipeline import log_pipeline
+from src.tracing import tracer
+from src.rate_limit import admission, RateLimited
+from src import sql_instrumentation
+from src.db_routing import read_replica, route_request, remember_write, primary_stickiness
+from src.auth import token_required, invalidate_credentials, get_token_signer
+from src.conditional import conditional_get, user_version, image_version, user_etag, image_etag, with_etag
 import re
 from datetime import datetime, timedelta
 from src.config import Config, TestConfig
-from src.sns_operations import send_verification_email
-import time
+from src.sns_operations import queue_verification_email, outbox_dispatcher
+from src.hashing import hash_password, HashPoolUnavailable, discard_hash_pool
+from src.image_variants import variant_pipeline
+from src.bulk_import import import_users, ImportReport
 import boto3
+import click
+import hmac
+import json
+import threading
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config as BotoConfig
 import logging
 
 os.environ['CLICOLOR'] = '0'
 
-logging.basicConfig(
-    filename='/var/log/webapp.log',
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 
@@ -30,22 +46,68 @@ if os.getenv('FLASK_ENV') == 'testing' or os.getenv('PYTEST_CURRENT_TEST') == 'T
 else:
     app.config.from_object(Config)
 
-db.init_app(app)
-
-initialized = False
+# JSON records go through a queue to a background writer, never straight to disk
+log_pipeline.init_app(app)
+tracer.init_app(app)
 
-# bootstrap database
-def initialize_database():
-    global initialized
-    if not initialized:
-        with app.app_context():
-            try:
-                db.create_all()
-                initialized = True
-            except (OperationalError, DBAPIError):
-                initialized = False
+# behind the load balancer, remote_addr is taken from X-Forwarded-For as set by the trusted hops
+if app.config.get('TRUSTED_PROXIES'):
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXIES'])
 
-initialize_database()
+db.init_app(app)
+if app.config.get('DB_CREDENTIALS_HOOK'):
+    with app.app_context():
+        for engine in db.engines.values():
+            event.listen(engine, 'do_connect', app.config['DB_CREDENTIALS_HOOK'])
+db_breaker.init_app(app)
+outbox_dispatcher.init_app(app)
+profiler.init_app(app)
+admission.init_app(app)
+sql_instrumentation.query_budget = app.config.get('SQL_QUERY_BUDGET', 10)
+sql_instrumentation.comment_tags = app.config.get('SQL_COMMENT_TAGS', True)
+primary_stickiness.seconds = app.config.get('DB_STICKY_SECONDS', 5)
+route_sample_rates.update(parse_sample_rates(app.config.get('METRICS_SAMPLE_RATES')))
+
+@app.cli.command("migrate")
+def migrate_command():
+    """Apply pending database migrations."""
+    with app.app_context():
+        applied = run_migrations(db.engine)
+    print(f"Applied {len(applied)} migration(s): {', '.join(applied) or 'none'}")
+
+@app.cli.command("reap-unverified")
+@click.option('--batch-size', default=500, show_default=True, help='Users deleted per transaction.')
+@click.option('--pause', default=0.1, show_default=True, help='Seconds to wait between batches.')
+@click.option('--max-batches', default=None, type=int, help='Stop after this many batches.')
+def reap_unverified_command(batch_size, pause, max_batches):
+    """Delete unverified users whose verification token has expired."""
+    with app.app_context():
+        removed = reap_expired_users(batch_size=batch_size, pause_seconds=pause, max_batches=max_batches)
+    print(f"Removed {removed} expired unverified user(s)")
+
+@app.cli.command("import-users")
+@click.argument('source', type=click.File('rb'))
+@click.option('--chunk-size', default=500, show_default=True, help='Users inserted per transaction.')
+@click.option('--verification-email/--no-verification-email', default=True, show_default=True,
+              help='Queue verification emails, or leave them until the user registers again.')
+@click.option('--token-minutes', default=None, type=int,
+              help='Lifetime of the verification tokens, defaults to IMPORT_TOKEN_MINUTES.')
+def import_users_command(source, chunk_size, verification_email, token_minutes):
+    """Create users from an NDJSON file, '-' reads stdin. Failed records are written to stderr."""
+    with app.app_context():
+        report = import_users(source, chunk_size=chunk_size, send_verification=verification_email,
+                              token_minutes=token_minutes or app.config.get('IMPORT_TOKEN_MINUTES', 7 * 24 * 60),
+                              on_chunk=lambda r: click.echo(f"imported {r.imported}, failed {len(r.errors)}", err=True))
+    for error in report.errors:
+        click.echo(json.dumps(error), err=True)
+    print(f"Imported {report.imported} user(s), {len(report.errors)} failed")
+
+# called in each pre-forked worker, pooled connections and executors can't be shared
+def reset_after_fork():
+    with app.app_context():
+        db.engine.dispose(close=False)
+    discard_hash_pool()
+    variant_pipeline.discard_executor()
 
 @app.teardown_appcontext
 def shutdown_session(exception=None):
@@ -56,29 +118,53 @@ def shutdown_session(exception=None):
 
 @app.before_request
 def before_request():
-    if not check_db_connection():
+    log_pipeline.start_request()
+    tracer.start_request()
+    start_request_metrics()
+    profiler.start_request()
+    # reject oversized bodies from the header alone, before auth or spooling
+    max_content_length = app.config.get('MAX_CONTENT_LENGTH')
+    if max_content_length and request.content_length and request.content_length > max_content_length:
+        return Response(status=413, headers={
+            "Cache-Control": "no-cache, no-store, must-revalidate",
+            "Pragma": "no-cache"
+        })
+    db_breaker.start_monitor()
+    outbox_dispatcher.start()
+    route_request(app.view_functions.get(request.endpoint))
+    if request.endpoint == 'health_check' and is_deep_health_check():
+        return None
+    if not db_breaker.allow_request():
         return Response(status=503, headers={
             "Cache-Control": "no-cache, no-store, must-revalidate",
             "Pragma": "no-cache"
         })
 
-def check_db_connection():
-    try:
-        db.session.execute(text('SELECT 1'))
-        return True
-    except (OperationalError, DBAPIError):
-        return False
+@app.after_request
+def after_request(response):
+    set_request_status(response.status_code)
+    log_pipeline.finish_request(response)
+    return remember_write(response)
+
+@app.teardown_request
+def teardown_request(exception=None):
+    profiler.finish_request()
+    sql_instrumentation.finish_request_queries()
+    tracer.finish_request(g.get('metrics_status'))
+    finish_request_metrics()
+
+def is_deep_health_check():
+    return request.headers.get('X-Health-Check', '').lower() == 'deep'
 
 # health check
 @app.route('/healthz', methods=['GET'])
 def health_check():
-    log_api_call_count("HealthCheck")
-    start_time = time.time()
-    # 503 Service Unavailable
-    if not check_db_connection():
+    # deep mode probes the database now instead of trusting the circuit breaker
+    if is_deep_health_check() and not db_breaker.probe():
         return Response(status=503, headers={
             "Cache-Control": "no-cache, no-store, must-revalidate",
-            "Pragma": "no-cache"
+            "Pragma": "no-cache",
+            "X-DB-Circuit": db_breaker.state
         })
     # 400 Bad Request
     if request.args or request.get_data(as_text=True):
@@ -86,21 +172,49 @@ def health_check():
             "Cache-Control": "no-cache, no-store, must-revalidate",
             "Pragma": "no-cache"
         })
+    # 200 OK
+    return Response(status=200, headers={
+        "Cache-Control": "no-cache, no-store, must-revalidate",
+        "Pragma": "no-cache",
+        "X-DB-Circuit": db_breaker.state
+    })
+
+@app.errorhandler(OperationalError)
+@app.errorhandler(InterfaceError)
+def database_unavailable(e):
     try:
-        # 200 OK
-        db.session.execute(text('SELECT 1'))
-        time_elapsed = (time.time() - start_time) * 1000
-        log_api_call_duration("HealthCheck", time_elapsed)
-        return Response(status=200, headers={
-            "Cache-Control": "no-cache, no-store, must-revalidate",
-            "Pragma": "no-cache"
-        })
-    except (OperationalError, DBAPIError) as e:
-        # 503 Service Unavailable
-        return Response(status=503, headers={
+        db.session.rollback()
+    except (OperationalError, DBAPIError):
+        pass
+    if not db_breaker.confirm_outage():
+        # 500 Internal Server Error, a deadlock or lock-wait timeout with the primary still up
+        logger.exception("Database error on %s %s", request.method, request.path, exc_info=e)
+        return Response(status=500, headers={
             "Cache-Control": "no-cache, no-store, must-revalidate",
             "Pragma": "no-cache"
         })
+    # 503 Service Unavailable, the probe has counted it against the circuit
+    return Response(status=503, headers={
+        "Cache-Control": "no-cache, no-store, must-revalidate",
+        "Pragma": "no-cache"
+    })
+
+@app.errorhandler(RateLimited)
+def rate_limited(e):
+    # 429 Too Many Requests, shed before any password hashing
+    return Response(status=429, headers={
+        "Retry-After": str(e.retry_after),
+        "Cache-Control": "no-cache, no-store, must-revalidate",
+        "Pragma": "no-cache"
+    })
+
+@app.errorhandler(413)
+def request_entity_too_large(e):
+    # 413 Payload Too Large
+    return Response(status=413, headers={
+        "Cache-Control": "no-cache, no-store, must-revalidate",
+        "Pragma": "no-cache"
+    })
 
 @app.errorhandler(405)
 def method_not_allowed(e):
@@ -110,21 +224,10 @@ def method_not_allowed(e):
         "Pragma": "no-cache"
     })
 
-EMAIL_REGEX = r'^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$'
 
 # Create user
 @app.route('/v1/user', methods=['POST'])
 def create_user():
-    log_api_call_count("CreateUser")
-    start_time = time.time()
-    if not check_db_connection():
-        return Response(status=503, headers={
-            "Cache-Control": "no-cache, no-store, must-revalidate",
-            "Pragma": "no-cache"
-        })
-    if not initialized:
-        initialize_database()
-
     data = request.get_json()
     email = data.get('email')
     password = data.get('password')
@@ -141,28 +244,40 @@ def create_user():
     
     existing_user = User.query.filter_by(email=email).first()
     if existing_user:
-        if existing_user.is_verified == "True":
+        if existing_user.is_verified:
             return jsonify({'error': 'User already exists'}), 400
         else:
             # regist but not verified, resend verification email
             verification_token = str(uuid.uuid4())
             token_expiration = datetime.now() + timedelta(minutes=2)
-            existing_user.password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+            admission.admit(email)
+            try:
+                with admission.password_work():
+                    existing_user.password = hash_password(password)
+            except HashPoolUnavailable:
+                return Response(status=503, headers={
+                    "Cache-Control": "no-cache, no-store, must-revalidate",
+                    "Pragma": "no-cache"
+                })
             existing_user.verification_token = verification_token
             existing_user.token_expiration = token_expiration
+            queue_verification_email(email, verification_token)
 
-            db_start_time = time.time()
             db.session.commit()
-            db_time_elapsed = (time.time() - db_start_time) * 1000
-            log_api_call_duration("CreateUserDB", db_time_elapsed)
 
-            send_verification_email(email, verification_token)
-            time_elapsed = (time.time() - start_time) * 1000
-            log_api_call_duration("CreateUser", time_elapsed)
+            outbox_dispatcher.notify()
             return jsonify({'message': 'Verification email resent. Please check your email.'}), 200
 
     # send verification email for new user
-    hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+    admission.admit(email)
+    try:
+        with admission.password_work():
+            hashed_password = hash_password(password)
+    except HashPoolUnavailable:
+        return Response(status=503, headers={
+            "Cache-Control": "no-cache, no-store, must-revalidate",
+            "Pragma": "no-cache"
+        })
     verification_token = str(uuid.uuid4())
     token_expiration = datetime.now() + timedelta(minutes=2)
     new_user = User(
@@ -175,76 +290,91 @@ def create_user():
         token_expiration=token_expiration,
     )
     db.session.add(new_user)
+    queue_verification_email(email, verification_token)
 
-    db_start_time = time.time()
     db.session.commit()
-    db_time_elapsed = (time.time() - db_start_time) * 1000
-    log_api_call_duration("CreateUserDB", db_time_elapsed)
 
-    send_verification_email(email, verification_token)
-    time_elapsed = (time.time() - start_time) * 1000
-    log_api_call_duration("CreateUser", time_elapsed)
+    outbox_dispatcher.notify()
     return jsonify({'message': 'User created successfully. Please verify your email.', 'user_id': new_user.id}), 201
 
 
 # get user info
 @app.route('/v1/user/self', methods=['GET'])
+@read_replica
+@conditional_get(user_version)
 @token_required
-def get_user_info():
-    log_api_call_count("GetUserInfo")
-    start_time = time.time()
-    if not check_db_connection():
-        return Response(status=503, headers={
-            "Cache-Control": "no-cache, no-store, must-revalidate",
-            "Pragma": "no-cache"
-        })
-    if not initialized:
-        initialize_database()
-
-    auth = request.authorization
-    db_start_time = time.time()
-    user = User.query.filter_by(email=auth.username).first()
-    db_time_elapsed = (time.time() - db_start_time) * 1000
-    log_api_call_duration("GetUserInfoDB", db_time_elapsed)
-
-    if not user:
-        return jsonify({'error': 'User not found'}), 404
-    if user.is_verified == "False":
+def get_user_info(user):
+    if not user.is_verified:
         return jsonify({'error': 'User not verified'}), 403
     
-    time_elapsed = (time.time() - start_time) * 1000
-    log_api_call_duration("GetUserInfo", time_elapsed)
-    return jsonify({
+    return with_etag(jsonify({
         'email': user.email,
         'first_name': user.first_name,
         'last_name': user.last_name,
         'account_created': user.account_created,
         'account_updated': user.account_updated,
         'user_id': user.id
-    }), 200
+    }), user_etag(user.id, user.account_updated)), 200
 
 
-# update user info
-@app.route('/v1/user/self', methods=['PUT'])
-@token_required
-def update_user():
-    log_api_call_count("UpdateUser")
-    start_time = time.time()
-    if not check_db_connection():
+# bulk import for migrating accounts, disabled unless IMPORT_TOKEN is set
+@app.route('/v1/user/import', methods=['POST'])
+def import_users_endpoint():
+    token = app.config.get('IMPORT_TOKEN')
+    if not token:
+        return jsonify({'error': 'Not found'}), 404
+    if not hmac.compare_digest(request.headers.get('X-Import-Token', ''), token):
+        return jsonify({'message': 'Invalid import token'}), 401
+    report = ImportReport()
+    try:
+        # the body is read line by line, never buffered whole
+        import_users(request.stream, report=report,
+                     chunk_size=app.config.get('IMPORT_CHUNK_SIZE', 500),
+                     send_verification=request.args.get('send_verification', 'true').lower() != 'false',
+                     token_minutes=request.args.get('token_minutes', type=int)
+                     or app.config.get('IMPORT_TOKEN_MINUTES', 7 * 24 * 60),
+                     on_chunk=lambda _: outbox_dispatcher.notify())
+    except RequestEntityTooLarge:
+        # a chunked body outgrew MAX_CONTENT_LENGTH mid-stream, the chunks before it are committed
+        db.session.rollback()
+        # lines after last_line get resent, their parse errors would be reported again
+        report.errors = sorted((error for error in report.errors if error['line'] <= report.last_line),
+                               key=lambda error: error['line'])
+        return jsonify({'error': 'Request body too large, resend the lines after last_line',
+                        **report.to_dict()}), 413
+    except HashPoolUnavailable:
         return Response(status=503, headers={
             "Cache-Control": "no-cache, no-store, must-revalidate",
             "Pragma": "no-cache"
         })
-    if not initialized:
-        initialize_database()
+    return jsonify(report.to_dict()), 200
+
 
+# exchange Basic credentials for a short-lived bearer token, so later calls skip bcrypt
+@app.route('/v1/user/self/token', methods=['POST'])
+@token_required
+def issue_token(user):
+    if request.authorization.type != 'basic':
+        return jsonify({'message': 'Password required'}), 401
+    if not user.is_verified:
+        return jsonify({'error': 'User not verified'}), 403
+    signer = get_token_signer()
+    if signer.current_kid is None:
+        return jsonify({'error': 'Bearer tokens are not configured'}), 503
+    token, expires_at = signer.issue(user.id, user.token_version or 0)
+    response = jsonify({'token': token, 'token_type': 'Bearer', 'expires_in': signer.ttl_seconds,
+                        'expires_at': expires_at})
+    response.headers['Cache-Control'] = 'no-store'
+    return response, 201
+
+
+# update user info
+@app.route('/v1/user/self', methods=['PUT'])
+@token_required
+def update_user(user):
     data = request.get_json()
-    auth = request.authorization
 
-    user = User.query.filter_by(email=auth.username).first()
-    if not user:
-        return jsonify({'error': 'User not found'}), 404
-    if user.is_verified == "False":
+    if not user.is_verified:
         return jsonify({'error': 'User not verified'}), 403
 
     # allowed fields
@@ -262,87 +392,163 @@ def update_user():
         password = data['password']
         if not password:
             return jsonify({'error': 'Password is required'}), 400
-        hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+        admission.admit(user.email)
+        try:
+            with admission.password_work():
+                hashed_password = hash_password(password)
+        except HashPoolUnavailable:
+            return Response(status=503, headers={
+                "Cache-Control": "no-cache, no-store, must-revalidate",
+                "Pragma": "no-cache"
+            })
         user.password = hashed_password
+        invalidate_credentials(user.email)
+        # bearer tokens issued before the change stop working
+        user.token_version = (user.token_version or 0) + 1
 
     # Update account_updated time
     user.account_updated = datetime.now()
-    db_start_time = time.time()
     db.session.commit()
-    db_time_elapsed = (time.time() - db_start_time) * 1000
-    log_api_call_duration("UpdateUserDB", db_time_elapsed)
 
-    time_elapsed = (time.time() - start_time) * 1000
-    log_api_call_duration("UpdateUser", time_elapsed)
     return jsonify({}), 204
 
 
-s3_client = boto3.client("s3", region_name="us-west-2")
-
-def upload_file_to_s3(file, bucket_name, object_name):
-    start_time = time.time()
+# transfer concurrency can't use more connections than the client pool holds
+s3_transfer_config = TransferConfig(
+    multipart_threshold=app.config.get('S3_MULTIPART_THRESHOLD', 8 * 1024 * 1024),
+    multipart_chunksize=app.config.get('S3_MULTIPART_CHUNKSIZE', 8 * 1024 * 1024),
+    max_concurrency=app.config.get('S3_MAX_CONCURRENCY', 4),
+)
+s3_client = None
+_s3_client_lock = threading.Lock()
+
+def get_s3_client():
+    # built on first use, creating a boto3 client costs noticeable startup time
+    global s3_client
+    if s3_client is None:
+        with _s3_client_lock:
+            if s3_client is None:
+                s3_client = boto3.client("s3", region_name="us-west-2", config=BotoConfig(
+                    max_pool_connections=max(app.config.get('S3_MAX_POOL_CONNECTIONS', 10),
+                                             s3_transfer_config.max_request_concurrency)
+                ))
+    return s3_client
+
+def upload_file_to_s3(file, bucket_name, object_name, content_type=None):
+    extra_args = {"ContentType": content_type} if content_type else None
     try:
-        s3_client.upload_fileobj(file, bucket_name, object_name)
-        time_elapsed = (time.time() - start_time) * 1000
-        log_api_call_duration("S3Upload", time_elapsed)
+        with timed("S3", "S3Upload", key=object_name):
+            get_s3_client().upload_fileobj(file, bucket_name, object_name, ExtraArgs=extra_args, Config=s3_transfer_config)
         return True
-    except Exception as e:
-        print(e)
+    except Exception:
+        logger.exception("S3 upload of %s failed", object_name)
         return False
     
 def delete_file_from_s3(bucket_name, object_name):
-    start_time = time.time()
     try:
-        s3_client.delete_object(Bucket=bucket_name, Key=object_name)
-        time_elapsed = (time.time() - start_time) * 1000
-        log_api_call_duration("S3Delete", time_elapsed)
+        with timed("S3", "S3Delete", key=object_name):
+            get_s3_client().delete_object(Bucket=bucket_name, Key=object_name)
         return True
-    except Exception as e:
-        print(e)
+    except Exception:
+        logger.exception("S3 delete of %s failed", object_name)
         return False
+
+def delete_variants_from_s3(bucket_name, image):
+    # best effort, a leftover rendition is harmless
+    for variant in image.variants:
+        delete_file_from_s3(bucket_name, variant.url.split('/', 1)[1])
+
+variant_pipeline.init_app(app, get_s3_client)
+
+def create_presigned_upload(bucket_name, object_name, content_type, max_size, expires_in):
+    try:
+        # signed locally, no request goes to S3
+        return get_s3_client().generate_presigned_post(
+            Bucket=bucket_name,
+            Key=object_name,
+            Fields={"Content-Type": content_type},
+            Conditions=[
+                {"Content-Type": content_type},
+                ["content-length-range", 1, max_size],
+            ],
+            ExpiresIn=expires_in,
+        )
+    except Exception:
+        logger.exception("Presigning an upload for %s failed", object_name)
+        return None
+
+def head_s3_object(bucket_name, object_name):
+    try:
+        with timed("S3", "S3Head", key=object_name):
+            return get_s3_client().head_object(Bucket=bucket_name, Key=object_name)
+    except Exception:
+        logger.exception("S3 head of %s failed", object_name)
+        return None
+
+ALLOWED_IMAGE_TYPES = {
+    "image/png": "png",
+    "image/jpeg": "jpg",
+    "image/jpg": "jpg",
+}
+# the object name presign hands out under the user's prefix; rendition keys like {uuid}_thumbnail.png never match
+PRESIGNED_KEY_REGEX = (r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\.(%s)'
+                       % '|'.join(sorted(set(ALLOWED_IMAGE_TYPES.values()))))
     
+def replace_profile_image(user, bucket_name, file_name, original_name):
+    """Swap the user's picture row for an object already in S3, then drop the old objects.
+
+    The old keys are deleted only after the commit, so a failed commit never leaves the row
+    pointing at a deleted object.
+    """
+    replaced_keys = []
+    existing_image = user.image
+    if existing_image:
+        replaced_keys = [f"{user.id}/{existing_image.url.split('/')[-1]}"]
+        replaced_keys += [variant.url.split('/', 1)[1] for variant in existing_image.variants]
+        db.session.delete(existing_image)
+        # images.user_id is unique, the old row has to go before the new one is inserted
+        db.session.flush()
+    new_image = Image(
+        file_name=original_name,
+        url=f"{bucket_name}/{file_name}",
+        user_id=user.id,
+        upload_date=datetime.now()
+    )
+    db.session.add(new_image)
+
+    db.session.commit()
+    variant_pipeline.submit(new_image.id, bucket_name, file_name)
+    # best effort once the new picture is in place, a leftover object is harmless
+    for key in replaced_keys:
+        delete_file_from_s3(bucket_name, key)
+    return new_image
+
 @app.route('/v1/user/self/pic', methods=['POST'])
 @token_required
-def upload_profile_pic():
-    log_api_call_count("UploadProfilePic")
-    start_time = time.time()
-    auth = request.authorization
-    user = User.query.filter_by(email=auth.username).first()
-    
-    if not user:
-        return jsonify({'error': 'User not found'}), 404
-    if user.is_verified == "False":
+def upload_profile_pic(user):
+    if not user.is_verified:
         return jsonify({'error': 'User not verified'}), 403
 
-    if 'profilePic' not in request.files:
-        return jsonify({'error': 'No file uploaded'}), 400
-
-    file = request.files['profilePic']
-    file_name = f"{user.id}/{uuid.uuid4()}.{file.filename.split('.')[-1]}"
+    # a raw image body is streamed straight from the socket to S3, without a temp file
+    if request.mimetype in ALLOWED_IMAGE_TYPES:
+        file = request.stream
+        content_type = request.mimetype
+        extension = ALLOWED_IMAGE_TYPES[content_type]
+        original_name = request.headers.get('X-File-Name') or f"profile.{extension}"
+    else:
+        if 'profilePic' not in request.files:
+            return jsonify({'error': 'No file uploaded'}), 400
+        file = request.files['profilePic']
+        content_type = file.mimetype or None
+        original_name = file.filename
+        extension = file.filename.split('.')[-1]
+
+    file_name = f"{user.id}/{uuid.uuid4()}.{extension}"
     bucket_name = app.config['S3_BUCKET_NAME']
 
-    existing_image = Image.query.filter_by(user_id=user.id).first()
-    if existing_image:
-        if not delete_file_from_s3(bucket_name, f"{user.id}/{existing_image.url.split('/')[-1]}"):
-            return jsonify({'error': 'Failed to delete existing profile picture'}), 500
-        db.session.delete(existing_image)
-
-    if upload_file_to_s3(file, bucket_name, file_name):
-        new_image = Image(
-            file_name=file.filename,
-            url=f"{bucket_name}/{file_name}",
-            user_id=user.id,
-            upload_date=datetime.now()
-        )
-        db.session.add(new_image)
-        
-        db_start_time = time.time()
-        db.session.commit()
-        db_time_elapsed = (time.time() - db_start_time) * 1000
-        log_api_call_duration("UploadProfilePicDB", db_time_elapsed)
-        
-        time_elapsed = (time.time() - start_time) * 1000
-        log_api_call_duration("UploadProfilePic", time_elapsed)
+    # upload first, so no transaction or row lock is held across the S3 round-trip
+    if upload_file_to_s3(file, bucket_name, file_name, content_type):
+        new_image = replace_profile_image(user, bucket_name, file_name, original_name)
 
         return jsonify({
             "file_name": new_image.file_name,
@@ -355,67 +561,116 @@ def upload_profile_pic():
         return jsonify({'error': 'File upload failed'}), 500
     
 @app.route('/v1/user/self/pic', methods=['GET'])
+@read_replica
+@conditional_get(image_version)
 @token_required
-def get_profile_pic():
-    log_api_call_count("GetProfilePic")
-    start_time = time.time()
-    auth = request.authorization
-    user = User.query.filter_by(email=auth.username).first()
-    
-    if not user:
-        return jsonify({'error': 'User not found'}), 404
-    if user.is_verified == "False":
+def get_profile_pic(user):
+    if not user.is_verified:
         return jsonify({'error': 'User not verified'}), 403
 
-    image = Image.query.filter_by(user_id=user.id).first()
+    image = user.image
     if not image:
-        time_elapsed = (time.time() - start_time) * 1000
-        log_api_call_duration("GetProfilePic", time_elapsed)
         return jsonify({'error': 'Profile picture not found'}), 404
 
-    time_elapsed = (time.time() - start_time) * 1000
-    log_api_call_duration("GetProfilePic", time_elapsed)
-    return jsonify({
+    return with_etag(jsonify({
         "file_name": image.file_name,
         "id": image.id,
         "url": image.url,
         "upload_date": image.upload_date.strftime("%Y-%m-%d"),
-        "user_id": image.user_id
-    }), 200
+        "user_id": image.user_id,
+        "variants": {variant.label: variant.url for variant in image.variants}
+    }), image_etag(image.id, image.upload_date, len(image.variants))), 200
 
 @app.route('/v1/user/self/pic', methods=['DELETE'])
 @token_required
-def delete_profile_pic():
-    log_api_call_count("DeleteProfilePic")
-    start_time = time.time()
-    auth = request.authorization
-    user = User.query.filter_by(email=auth.username).first()
-    
-    if not user:
-        return jsonify({'error': 'User not found'}), 404
-    if user.is_verified == "False":
+def delete_profile_pic(user):
+    if not user.is_verified:
         return jsonify({'error': 'User not verified'}), 403
 
-    image = Image.query.filter_by(user_id=user.id).first()
+    image = user.image
     if not image:
         return jsonify({'error': 'Profile picture not found'}), 404
 
     bucket_name = app.config['S3_BUCKET_NAME']
     if delete_file_from_s3(bucket_name, f"{user.id}/{image.url.split('/')[-1]}"):
+        delete_variants_from_s3(bucket_name, image)
         db.session.delete(image)
         
-        db_start_time = time.time()
         db.session.commit()
-        db_time_elapsed = (time.time() - db_start_time) * 1000
-        log_api_call_duration("DeleteProfilePicDB", db_time_elapsed)
 
-        time_elapsed = (time.time() - start_time) * 1000
-        log_api_call_duration("DeleteProfilePic", time_elapsed)
 
         return Response(status=204)
     else:
         return jsonify({'error': 'File deletion failed'}), 500
 
+# presigned upload, step 1: the client posts the file straight to S3
+@app.route('/v1/user/self/pic/presign', methods=['POST'])
+@token_required
+def presign_profile_pic(user):
+    if not user.is_verified:
+        return jsonify({'error': 'User not verified'}), 403
+
+    data = request.get_json(silent=True) or {}
+    content_type = data.get('content_type')
+    if content_type not in ALLOWED_IMAGE_TYPES:
+        return jsonify({'error': 'Unsupported content type'}), 400
+
+    file_name = f"{user.id}/{uuid.uuid4()}.{ALLOWED_IMAGE_TYPES[content_type]}"
+    bucket_name = app.config['S3_BUCKET_NAME']
+    presigned = create_presigned_upload(
+        bucket_name,
+        file_name,
+        content_type,
+        app.config.get('PROFILE_PIC_MAX_BYTES', 5 * 1024 * 1024),
+        app.config.get('PRESIGNED_URL_EXPIRATION', 300),
+    )
+    if not presigned:
+        return jsonify({'error': 'Failed to create upload URL'}), 500
+
+    return jsonify({
+        "key": file_name,
+        "upload_url": presigned['url'],
+        "fields": presigned['fields']
+    }), 200
+
+# presigned upload, step 2: check the uploaded object and record it
+@app.route('/v1/user/self/pic/complete', methods=['POST'])
+@token_required
+def complete_profile_pic(user):
+    if not user.is_verified:
+        return jsonify({'error': 'User not verified'}), 403
+
+    data = request.get_json(silent=True) or {}
+    file_name = data.get('key')
+    original_name = (data.get('file_name') or (file_name or '').split('/')[-1])[:255]
+    if (not isinstance(file_name, str) or not file_name.startswith(f"{user.id}/")
+            or not re.fullmatch(PRESIGNED_KEY_REGEX, file_name[len(user.id) + 1:])):
+        return jsonify({'error': 'Invalid upload key'}), 400
+
+    bucket_name = app.config['S3_BUCKET_NAME']
+    head = head_s3_object(bucket_name, file_name)
+    if not head:
+        return jsonify({'error': 'Uploaded file not found'}), 400
+    if (head.get('ContentType') not in ALLOWED_IMAGE_TYPES
+            or head.get('ContentLength', 0) > app.config.get('PROFILE_PIC_MAX_BYTES', 5 * 1024 * 1024)):
+        delete_file_from_s3(bucket_name, file_name)
+        return jsonify({'error': 'Uploaded file rejected'}), 400
+
+    existing_image = user.image
+    if existing_image:
+        if existing_image.url == f"{bucket_name}/{file_name}":
+            return jsonify({'error': 'Upload already completed'}), 400
+
+    new_image = replace_profile_image(user, bucket_name, file_name, original_name)
+
+    return jsonify({
+        "file_name": new_image.file_name,
+        "id": new_image.id,
+        "url": new_image.url,
+        "upload_date": new_image.upload_date.strftime("%Y-%m-%d"),
+        "user_id": new_image.user_id
+    }), 201
+
 @app.route('/v1/user/verify', methods=['GET'])
 def verify_user():
     token = request.args.get('token')
@@ -429,7 +684,7 @@ def verify_user():
     if user.token_expiration < datetime.now():
         return jsonify({'error': 'Verification token expired. Please register again.'}), 400
 
-    user.is_verified = "True"
+    user.is_verified = True
     user.verification_token = None
     user.token_expiration = None
     db.session.commit()
@@ -0,0 +1,65 @@
+"""Cold-start benchmark: time `import app` in fresh interpreters.
+
+Each run starts a new Python process, so nothing is shared between samples:
+
+    python -m benchmarks.bench_startup --runs 10
+    # exits 1 when the median import time is above the limit
+    python -m benchmarks.bench_startup --runs 10 --max-seconds 1.5
+
+The production Config is imported by default, that is the path deployments start through.
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+from benchmarks.bench_endpoints import percentile
+
+IMPORT_SNIPPET = "import time; t = time.perf_counter(); import app; print(time.perf_counter() - t)"
+
+
+def time_import(env):
+    result = subprocess.run(
+        [sys.executable, '-c', IMPORT_SNIPPET],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        env=env, capture_output=True, text=True, check=True,
+    )
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def run(runs, env=None, config='production'):
+    env = dict(os.environ if env is None else env)
+    if config == 'testing':
+        env['FLASK_ENV'] = 'testing'
+    else:
+        env.pop('FLASK_ENV', None)
+        env.pop('PYTEST_CURRENT_TEST', None)
+    env.setdefault('AWS_REGION', 'us-west-2')
+    samples = [time_import(env) for _ in range(runs)]
+    return {
+        'runs': runs,
+        'median_s': round(percentile(samples, 0.5), 4),
+        'p90_s': round(percentile(samples, 0.9), 4),
+        'max_s': round(max(samples), 4),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10, help='fresh interpreters to start')
+    parser.add_argument('--max-seconds', type=float, help='fail when the median import time is above this')
+    parser.add_argument('--config', choices=('production', 'testing'), default='production',
+                        help='which Config class app.py loads')
+    args = parser.parse_args(argv)
+
+    results = run(args.runs, config=args.config)
+    print(f"import app: median {results['median_s']}s  p90 {results['p90_s']}s  max {results['max_s']}s "
+          f"over {results['runs']} runs")
+    if args.max_seconds is not None and results['median_s'] > args.max_seconds:
+        print(f"REGRESSION median {results['median_s']}s > {args.max_seconds}s")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
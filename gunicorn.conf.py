@@ -0,0 +1,40 @@
+import os
+
+# async mode: each request is a greenlet, so waits on MySQL, S3 and SNS hold a socket, not a thread.
+# Patch before anything imports the app; PyMySQL and botocore are pure Python over the patched sockets.
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', '')
+if worker_class == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
+import multiprocessing
+
+# pre-forked workers with a thread pool each (or greenlets in async mode); bcrypt runs in its own pool
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.getenv('GUNICORN_WORKERS', multiprocessing.cpu_count()))
+threads = int(os.getenv('GUNICORN_THREADS', 4))
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 1000))
+worker_class = worker_class or ('gthread' if threads > 1 else 'sync')
+
+# import app.py once in the master so workers fork from a warm interpreter; reset_after_fork
+# drops the state that must not be shared with workers. Rate-limit state lives in a shared
+# file (RATE_LIMIT_PATH), so it is shared with or without preload
+preload_app = os.getenv('GUNICORN_PRELOAD', 'true').lower() == 'true'
+
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', 5))
+
+# recycle workers now and then so slow leaks can't build up
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', 10000))
+max_requests_jitter = int(os.getenv('GUNICORN_MAX_REQUESTS_JITTER', 1000))
+
+accesslog = None
+errorlog = '-'
+loglevel = os.getenv('GUNICORN_LOG_LEVEL', 'info')
+
+
+def post_fork(server, worker):
+    if server.cfg.preload_app:
+        from wsgi import reset_after_fork
+        reset_after_fork()
@@ -1,27 +1,222 @@
 from functools import wraps
-from flask import request, jsonify
-from src.models import User
-import bcrypt
+from flask import request, jsonify, current_app, Response
+from src.models import User, Image
+from sqlalchemy.orm import joinedload
+from src.metrics import log_cache_event
+from src.hashing import check_password, HashPoolUnavailable
+from src.rate_limit import admission
+from collections import OrderedDict
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import secrets
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# bounded TTL cache of recently verified credentials, so repeat requests skip bcrypt
+class CredentialCache:
+    def __init__(self, max_size=1024, ttl_seconds=300, secret=None):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        # keyed digest of the presented password, the plaintext is never stored
+        self._secret = secret or secrets.token_bytes(32)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _key(self, email, password):
+        digest = hmac.new(self._secret, password.encode('utf-8'), hashlib.sha256).hexdigest()
+        return (email, digest)
+
+    def check(self, email, password, password_hash):
+        key = self._key(email, password)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                log_cache_event("CredentialCache", "miss")
+                return False
+            cached_hash, expires_at = entry
+            # stale entry, or the stored hash changed since it was verified
+            if expires_at < time.monotonic() or not hmac.compare_digest(cached_hash, password_hash):
+                del self._entries[key]
+                log_cache_event("CredentialCache", "miss")
+                return False
+            self._entries.move_to_end(key)
+        log_cache_event("CredentialCache", "hit")
+        return True
+
+    def add(self, email, password, password_hash):
+        if self.max_size <= 0:
+            return
+        key = self._key(email, password)
+        with self._lock:
+            self._entries[key] = (password_hash, time.monotonic() + self.ttl_seconds)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                log_cache_event("CredentialCache", "eviction")
+
+    def invalidate(self, email):
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == email]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+credential_cache = None
+_credential_cache_lock = threading.Lock()
+
+def get_credential_cache():
+    global credential_cache
+    if credential_cache is None:
+        with _credential_cache_lock:
+            if credential_cache is None:
+                credential_cache = CredentialCache(
+                    max_size=current_app.config.get('CREDENTIAL_CACHE_SIZE', 1024),
+                    ttl_seconds=current_app.config.get('CREDENTIAL_CACHE_TTL', 300),
+                )
+    return credential_cache
+
+def invalidate_credentials(email):
+    get_credential_cache().invalidate(email)
+
+def _b64encode(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+def _b64decode(value):
+    return base64.urlsafe_b64decode(value + '=' * (-len(value) % 4))
+
+
+# short-lived bearer tokens: "<key id>.<claims>.<HMAC-SHA256>", checked without a database round-trip
+class TokenSigner:
+    def __init__(self, keys, ttl_seconds=900):
+        """keys is an ordered {key id: secret}; the first signs, all of them verify, so keys can be rotated.
+
+        With no keys nothing verifies and issue() raises, every worker has to share the same secrets.
+        """
+        self.keys = {kid: secret.encode('utf-8') if isinstance(secret, str) else secret for kid, secret in keys.items()}
+        self.current_kid = next(iter(self.keys), None)
+        self.ttl_seconds = ttl_seconds
+
+    def _sign(self, key, signing_input):
+        return _b64encode(hmac.new(key, signing_input.encode('ascii'), hashlib.sha256).digest())
+
+    def issue(self, user_id, token_version, now=None):
+        if self.current_kid is None:
+            raise ValueError("No signing key configured")
+        expires_at = int((now or time.time()) + self.ttl_seconds)
+        claims = _b64encode(json.dumps({'sub': user_id, 'ver': token_version, 'exp': expires_at},
+                                       separators=(',', ':')).encode('utf-8'))
+        signing_input = f"{self.current_kid}.{claims}"
+        return f"{signing_input}.{self._sign(self.keys[self.current_kid], signing_input)}", expires_at
+
+    def verify(self, token, now=None):
+        """Return the claims of a well-signed, unexpired token, or None."""
+        try:
+            kid, claims, signature = token.split('.')
+        except (AttributeError, ValueError):
+            return None
+        key = self.keys.get(kid)
+        if key is None:
+            return None
+        if not hmac.compare_digest(self._sign(key, f"{kid}.{claims}"), signature):
+            return None
+        try:
+            payload = json.loads(_b64decode(claims))
+        except ValueError:
+            return None
+        if payload.get('exp', 0) <= (now or time.time()):
+            return None
+        return payload
+
+
+def parse_token_keys(value):
+    """Parse "2024b:secret,2024a:older-secret" into an ordered {key id: secret}, newest first."""
+    keys = {}
+    for item in (value or '').split(','):
+        if item.strip():
+            kid, secret = item.split(':', 1)
+            keys[kid.strip()] = secret.strip()
+    return keys
+
+
+token_signer = None
+_token_signer_lock = threading.Lock()
+
+def get_token_signer():
+    global token_signer
+    if token_signer is None:
+        with _token_signer_lock:
+            if token_signer is None:
+                keys = parse_token_keys(current_app.config.get('AUTH_TOKEN_KEYS'))
+                if not keys:
+                    # a per-process random key would differ between gunicorn workers and die with each recycle
+                    logger.warning("AUTH_TOKEN_KEYS is not set, bearer tokens are disabled")
+                token_signer = TokenSigner(keys, current_app.config.get('AUTH_TOKEN_TTL', 900))
+    return token_signer
+
+def _as_bytes(value):
+    if(type(value) == str):
+        return value.encode('utf-8')
+    return value
+
+def verify_credentials(auth, password_hash):
+    """Check the presented credentials against the stored hash, returning an error response or None."""
+    password_hash = _as_bytes(password_hash)
+    cache = get_credential_cache()
+    if cache.check(auth.username, auth.password, password_hash):
+        return None
+    # only requests that would reach bcrypt are charged, cached credentials skip the buckets
+    admission.admit(auth.username)
+    try:
+        with admission.password_work():
+            verified = check_password(auth.password, password_hash)
+    except HashPoolUnavailable:
+        return Response(status=503, headers={
+            "Cache-Control": "no-cache, no-store, must-revalidate",
+            "Pragma": "no-cache"
+        })
+    if not verified:
+        return jsonify({'message': 'Invalid credentials'}), 401
+    cache.add(auth.username, auth.password, password_hash)
+    return None
 
 def token_required(f):
+    """Resolve the user from HTTP Basic credentials or a bearer token from the login endpoint."""
     @wraps(f)
     def decorated(*args, **kwargs):
         auth = request.authorization
         if not auth:
             return jsonify({'message': 'Authentication required!'}), 401
-        user = User.query.filter_by(email=auth.username).first()
+        # load the profile picture in the same round-trip, handlers reuse this user
+        query = User.query.options(joinedload(User.image).joinedload(Image.variants))
+        if auth.type == 'bearer':
+            # signature and expiry need no database, forged or stale tokens stop here
+            claims = get_token_signer().verify(auth.token)
+            if claims is None:
+                return jsonify({'message': 'Invalid or expired token'}), 401
+            user = query.filter_by(id=claims['sub']).first()
+            # a password change bumps token_version, revoking older tokens
+            if not user or user.token_version != claims.get('ver'):
+                return jsonify({'message': 'Invalid or expired token'}), 401
+            return f(user, *args, **kwargs)
+        user = query.filter_by(email=auth.username).first()
         if not user:
             return jsonify({'message': 'User not found'}), 404
-        user_password = user.password
-        if(type(user_password) == str):
-            user_password = user_password.encode('utf-8')
-        if not bcrypt.checkpw(auth.password.encode('utf-8'), user_password):
-            return jsonify({'message': 'Invalid credentials'}), 401
-        return f(*args, **kwargs)
+        error = verify_credentials(auth, user.password)
+        if error is not None:
+            return error
+        return f(user, *args, **kwargs)
     return decorated
 
 def check_auth(email, password):
     user = User.query.filter_by(email=email).first()
-    if user and bcrypt.checkpw(password.encode('utf-8'), user.password.encode('utf-8')):
+    if user and check_password(password, user.password):
         return True
     return False
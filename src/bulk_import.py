@@ -0,0 +1,162 @@
+import json
+import re
+import uuid
+from datetime import datetime, timedelta
+from sqlalchemy import insert
+from sqlalchemy.exc import IntegrityError
+from src.models import db, User, EmailOutbox, EMAIL_REGEX
+from src.sns_operations import build_verification_message
+from src.hashing import hash_passwords
+from src.metrics import log_count
+from src.log_pipeline import current_request_id
+
+BCRYPT_HASH_REGEX = r'^\$2[aby]\$\d\d\$[./A-Za-z0-9]{53}$'
+
+
+class ImportReport:
+    def __init__(self):
+        self.imported = 0
+        self.errors = []
+        # every line up to here is committed or reported, a cut-off upload resumes after it
+        self.last_line = 0
+
+    def fail(self, line_number, email, error):
+        self.errors.append({'line': line_number, 'email': email, 'error': error})
+
+    def to_dict(self):
+        return {'imported': self.imported, 'failed': len(self.errors), 'errors': self.errors,
+                'last_line': self.last_line}
+
+
+def parse_record(line):
+    """Validate one NDJSON line, returning (record, None) or (None, error)."""
+    try:
+        record = json.loads(line)
+    except ValueError:
+        return None, 'Invalid JSON'
+    if not isinstance(record, dict):
+        return None, 'Record must be a JSON object'
+    email = record.get('email')
+    if not email or not isinstance(email, str):
+        return None, 'Email is required'
+    if not re.match(EMAIL_REGEX, email):
+        return None, 'Invalid email address'
+    password, password_hash = record.get('password'), record.get('password_hash')
+    if password_hash is not None:
+        # legacy accounts can move over with their bcrypt hash, skipping the rehash
+        if not isinstance(password_hash, str) or not re.match(BCRYPT_HASH_REGEX, password_hash):
+            return None, 'password_hash must be a bcrypt hash'
+    elif not password or not isinstance(password, str):
+        return None, 'Password is required'
+    if not record.get('first_name') or not record.get('last_name'):
+        return None, 'first_name and last_name are required'
+    return record, None
+
+
+def import_users(lines, chunk_size=500, send_verification=True, token_minutes=7 * 24 * 60, on_chunk=None,
+                 report=None):
+    """Create users from NDJSON lines, one committed multi-row insert per chunk.
+
+    Bad records are reported with their line number and skipped, they never abort the batch.
+    Verification emails go through the outbox with the users; with send_verification=False
+    no token is issued, and registering again later sends one. Tokens live for days rather than
+    the sign-up minutes: the outbox drains a large import slowly, and the reaper deletes unverified
+    users whose token has expired. Pass a report to keep the progress when reading lines raises.
+    """
+    report = report or ImportReport()
+    chunk = []
+    line_number = 0
+    for line_number, line in enumerate(lines, start=1):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', errors='replace')
+        if not line.strip():
+            continue
+        record, error = parse_record(line)
+        if error:
+            report.fail(line_number, None, error)
+            continue
+        chunk.append((line_number, record))
+        if len(chunk) >= chunk_size:
+            _import_chunk(chunk, report, send_verification, token_minutes)
+            report.last_line = line_number
+            chunk = []
+            if on_chunk:
+                on_chunk(report)
+    if chunk:
+        _import_chunk(chunk, report, send_verification, token_minutes)
+        if on_chunk:
+            on_chunk(report)
+    report.last_line = line_number
+    if report.errors:
+        # chunk-level failures are found after the parse errors that follow them
+        report.errors.sort(key=lambda error: error['line'])
+        log_count("UserImport.failed", len(report.errors))
+    return report
+
+
+def _import_chunk(chunk, report, send_verification, token_minutes):
+    existing = {row.email for row in db.session.query(User.email)
+                .filter(User.email.in_([record['email'] for _, record in chunk]))}
+    pending = []
+    for line_number, record in chunk:
+        if record['email'] in existing:
+            report.fail(line_number, record['email'], 'User already exists')
+        else:
+            # earlier chunks are committed, so only duplicates within this one need catching here
+            existing.add(record['email'])
+            pending.append((line_number, record))
+    if not pending:
+        return
+
+    request_id = current_request_id()
+    to_hash = [record['password'] for _, record in pending if record.get('password_hash') is None]
+    hashed = iter(hash_passwords(to_hash))
+    now = datetime.now()
+    users = []
+    for line_number, record in pending:
+        password_hash = record.get('password_hash') or next(hashed).decode('utf-8')
+        user = {
+            'id': str(uuid.uuid4()),
+            'email': record['email'],
+            'password': password_hash,
+            'first_name': record['first_name'],
+            'last_name': record['last_name'],
+            'account_created': now,
+            'account_updated': now,
+            'is_verified': False,
+            'verification_token': None,
+            'token_expiration': None,
+        }
+        message = None
+        if send_verification:
+            user['verification_token'] = str(uuid.uuid4())
+            user['token_expiration'] = now + timedelta(minutes=token_minutes)
+            message = {'payload': build_verification_message(user['email'], user['verification_token']),
+                       'status': 'pending', 'attempts': 0, 'next_attempt_at': now, 'created_at': now,
+                       'request_id': request_id}
+        users.append((line_number, user, message))
+
+    try:
+        _insert(users)
+        imported = len(users)
+    except IntegrityError:
+        # someone registered one of these emails since the check, fall back to row by row
+        db.session.rollback()
+        imported = 0
+        for line_number, user, message in users:
+            try:
+                _insert([(line_number, user, message)])
+                imported += 1
+            except IntegrityError:
+                db.session.rollback()
+                report.fail(line_number, user['email'], 'User already exists')
+    report.imported += imported
+    log_count("UserImport.imported", imported)
+
+
+def _insert(users):
+    db.session.execute(insert(User), [user for _, user, _ in users])
+    messages = [message for _, _, message in users if message is not None]
+    if messages:
+        db.session.execute(insert(EmailOutbox), messages)
+    db.session.commit()
@@ -0,0 +1,84 @@
+from functools import wraps
+from flask import request, Response
+from sqlalchemy import func, select
+from src.models import db, User, Image, ImageVariant
+from src.auth import verify_credentials, get_token_signer
+import hashlib
+
+
+def make_etag(*parts):
+    return hashlib.sha256(":".join(str(part) for part in parts).encode('utf-8')).hexdigest()[:32]
+
+def user_etag(user_id, account_updated):
+    return make_etag("user", user_id, account_updated)
+
+def image_etag(image_id, upload_date, variant_count):
+    # variants are attached after the upload, so their count is part of the version
+    return make_etag("image", image_id, upload_date, variant_count)
+
+def with_etag(response, etag):
+    response.set_etag(etag)
+    # private to the account, and clients must revalidate before reusing it
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+# narrow lookups: what is needed to authenticate (password hash, token version) plus the version columns
+def user_version(criterion):
+    row = db.session.execute(
+        select(User.password, User.token_version, User.is_verified, User.id, User.account_updated).filter(criterion)
+    ).first()
+    if row is None:
+        return None
+    return row.password, row.token_version, (user_etag(row.id, row.account_updated) if row.is_verified else None)
+
+def image_version(criterion):
+    variant_count = (select(func.count(ImageVariant.id))
+                     .where(ImageVariant.image_id == Image.id)
+                     .correlate(Image)
+                     .scalar_subquery())
+    row = db.session.execute(
+        select(User.password, User.token_version, User.is_verified, Image.id, Image.upload_date,
+               variant_count.label('variant_count'))
+        .outerjoin(Image, Image.user_id == User.id)
+        .filter(criterion)
+    ).first()
+    if row is None:
+        return None
+    if not row.is_verified or row.id is None:
+        return row.password, row.token_version, None
+    return row.password, row.token_version, image_etag(row.id, row.upload_date, row.variant_count)
+
+
+def conditional_get(version_lookup):
+    """Answer If-None-Match with 304 from a version lookup, before the full row is loaded.
+
+    Sits above token_required; anything other than an authenticated match falls through to it.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            auth = request.authorization
+            if auth and request.if_none_match:
+                claims = None
+                if auth.type == 'bearer':
+                    claims = get_token_signer().verify(auth.token)
+                    version = version_lookup(User.id == claims['sub']) if claims else None
+                else:
+                    version = version_lookup(User.email == auth.username)
+                if version is not None:
+                    password_hash, token_version, etag = version
+                    # If-None-Match uses the weak comparison, RFC 9110 13.1.2
+                    if etag is not None and request.if_none_match.contains_weak(etag):
+                        if claims is not None:
+                            # a revoked token falls through to token_required's 401
+                            if claims.get('ver') == token_version:
+                                return with_etag(Response(status=304), etag)
+                        else:
+                            error = verify_credentials(auth, password_hash)
+                            if error is not None:
+                                return error
+                            return with_etag(Response(status=304), etag)
+            return f(*args, **kwargs)
+        return decorated
+    return decorator
@@ -1,34 +1,104 @@
 import os
 import boto3
 import json
+import logging
+import threading
+import time
 from dotenv import load_dotenv
+from src.db_pool import engine_options
+
+logger = logging.getLogger(__name__)
 
 load_dotenv()
 
-def load_secrets(secret_name):
+_secrets = {}
+_secrets_lock = threading.Lock()
+
+def _read_secrets_cache(path, ttl):
     try:
-        client = boto3.client('secretsmanager', region_name=os.getenv('AWS_REGION'))
-        response = client.get_secret_value(SecretId=secret_name)
-        if 'SecretString' in response:
-            return json.loads(response['SecretString'])
-        else:
-            raise ValueError("Secrets not in expected format")
-    except Exception as e:
-        print(f"Error fetching secrets from Secrets Manager: {e}")
-        return {}
-    
-def set_sqlalchemy_database_uri():
+        with open(path) as cache_file:
+            cached = json.load(cache_file)
+        if time.time() - cached['fetched_at'] < ttl:
+            return cached['secrets']
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+
+def _write_secrets_cache(path, secrets):
+    try:
+        # owner-only, the file holds database credentials
+        fd = os.open(f"{path}.tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as cache_file:
+            json.dump({'fetched_at': time.time(), 'secrets': secrets}, cache_file)
+        os.replace(f"{path}.tmp", path)
+    except OSError as e:
+        logger.warning("Error writing secrets cache: %s", e)
+
+def load_secrets(secret_name):
+    """Fetch a secret once per process, optionally through an on-disk cache with a TTL."""
+    if secret_name in _secrets:
+        return _secrets[secret_name]
+    with _secrets_lock:
+        if secret_name in _secrets:
+            return _secrets[secret_name]
+        cache_path = os.getenv('SECRETS_CACHE_PATH')
+        cache_ttl = int(os.getenv('SECRETS_CACHE_TTL', 3600))
+        secrets = _read_secrets_cache(cache_path, cache_ttl) if cache_path else None
+        if secrets is None:
+            try:
+                client = boto3.client('secretsmanager', region_name=os.getenv('AWS_REGION'))
+                response = client.get_secret_value(SecretId=secret_name)
+                if 'SecretString' in response:
+                    secrets = json.loads(response['SecretString'])
+                else:
+                    raise ValueError("Secrets not in expected format")
+            except Exception as e:
+                # not cached, the next connection attempt tries again
+                logger.error("Error fetching secrets from Secrets Manager: %s", e)
+                return {}
+            if cache_path:
+                _write_secrets_cache(cache_path, secrets)
+        _secrets[secret_name] = secrets
+        return secrets
+
+def inject_db_credentials(dialect, conn_rec, cargs, cparams):
+    # do_connect hook: credentials are looked up on the first real connection, not at import
     db_secrets = load_secrets(os.getenv('DB_SECRETS_NAME'))
-    db_username = db_secrets.get('username')
-    db_password = db_secrets.get('password')
-    db_host = os.getenv('RDS_ENDPOINT')
+    cparams['user'] = db_secrets.get('username')
+    cparams['password'] = db_secrets.get('password')
+
+def set_sqlalchemy_database_uri(db_host=None):
+    db_host = db_host or os.getenv('RDS_ENDPOINT')
     db_name = os.getenv('DB_NAME')
-    url = str(f"mysql+pymysql://{db_username}:{db_password}@{db_host}/{db_name}")
+    url = str(f"mysql+pymysql://{db_host}/{db_name}")
     return url
 
+def set_sqlalchemy_binds():
+    # one bind per reader endpoint, read-only requests are spread across them
+    readers = [host.strip() for host in os.getenv('RDS_READER_ENDPOINTS', '').split(',') if host.strip()]
+    return {f"replica_{i}": set_sqlalchemy_database_uri(host) for i, host in enumerate(readers)}
+
 class Config:
     SQLALCHEMY_DATABASE_URI = set_sqlalchemy_database_uri()
+    SQLALCHEMY_BINDS = set_sqlalchemy_binds()
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    DB_STICKY_SECONDS = int(os.getenv('DB_STICKY_SECONDS', 5))
+    METRICS_SAMPLE_RATES = os.getenv('METRICS_SAMPLE_RATES', '')
+    PROFILER_ENABLED = os.getenv('PROFILER_ENABLED', 'false').lower() == 'true'
+    PROFILER_TOKEN = os.getenv('PROFILER_TOKEN')
+    PROFILER_THRESHOLD_MS = float(os.getenv('PROFILER_THRESHOLD_MS', 500))
+    PROFILER_INTERVAL_MS = float(os.getenv('PROFILER_INTERVAL_MS', 5))
+    PROFILER_OUTPUT = os.getenv('PROFILER_OUTPUT', '/tmp/webapp-profile.folded')
+    SQL_QUERY_BUDGET = int(os.getenv('SQL_QUERY_BUDGET', 10))
+    SQL_COMMENT_TAGS = os.getenv('SQL_COMMENT_TAGS', 'true').lower() == 'true'
+    # recycle below MySQL's wait_timeout; pre-ping costs a round-trip per checkout, so it is opt-in
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(
+        pool_size=int(os.getenv('DB_POOL_SIZE', 10)),
+        max_overflow=int(os.getenv('DB_MAX_OVERFLOW', 5)),
+        pool_timeout=float(os.getenv('DB_POOL_TIMEOUT', 10)),
+        pool_recycle=int(os.getenv('DB_POOL_RECYCLE', 1800)),
+        pool_pre_ping=os.getenv('DB_POOL_PRE_PING', 'false').lower() == 'true',
+    )
     S3_BUCKET_NAME = os.getenv('S3_BUCKET_NAME')
     S3_ENDPOINT_URL = os.getenv('S3_ENDPOINT_URL')
     AWS_ACCESS_KEY_ID = os.getenv('AWS_ACCESS_KEY_ID')
@@ -36,6 +106,65 @@ class Config:
     AWS_REGION = os.getenv('AWS_REGION')
     SNS_TOPIC_ARN = os.getenv('SNS_TOPIC_ARN')
     BASE_URL = os.getenv('BASE_URL')
+    CREDENTIAL_CACHE_SIZE = int(os.getenv('CREDENTIAL_CACHE_SIZE', 1024))
+    CREDENTIAL_CACHE_TTL = int(os.getenv('CREDENTIAL_CACHE_TTL', 300))
+    BCRYPT_ROUNDS = int(os.getenv('BCRYPT_ROUNDS', 12))
+    HASH_POOL_WORKERS = int(os.getenv('HASH_POOL_WORKERS', 2))
+    HASH_QUEUE_SIZE = int(os.getenv('HASH_QUEUE_SIZE', 32))
+    DB_PROBE_INTERVAL = float(os.getenv('DB_PROBE_INTERVAL', 5))
+    DB_RESET_TIMEOUT = float(os.getenv('DB_RESET_TIMEOUT', 5))
+    # consecutive failed probes before the circuit opens, one slow probe should not shed every request
+    DB_FAILURE_THRESHOLD = int(os.getenv('DB_FAILURE_THRESHOLD', 3))
+    SNS_ENDPOINT_URL = os.getenv('SNS_ENDPOINT_URL')
+    PROFILE_PIC_MAX_BYTES = int(os.getenv('PROFILE_PIC_MAX_BYTES', 5 * 1024 * 1024))
+    PRESIGNED_URL_EXPIRATION = int(os.getenv('PRESIGNED_URL_EXPIRATION', 300))
+    MAX_CONTENT_LENGTH = int(os.getenv('MAX_CONTENT_LENGTH', 6 * 1024 * 1024))
+    S3_MULTIPART_THRESHOLD = int(os.getenv('S3_MULTIPART_THRESHOLD', 8 * 1024 * 1024))
+    S3_MULTIPART_CHUNKSIZE = int(os.getenv('S3_MULTIPART_CHUNKSIZE', 8 * 1024 * 1024))
+    S3_MAX_CONCURRENCY = int(os.getenv('S3_MAX_CONCURRENCY', 4))
+    S3_MAX_POOL_CONNECTIONS = int(os.getenv('S3_MAX_POOL_CONNECTIONS', 10))
+    IMAGE_VARIANT_SIZES = os.getenv('IMAGE_VARIANT_SIZES', 'thumbnail:64,medium:256')
+    IMAGE_VARIANT_WORKERS = int(os.getenv('IMAGE_VARIANT_WORKERS', 2))
+    OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', 10))
+    OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', 2))
+    OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 5))
+    OUTBOX_BACKOFF_BASE = float(os.getenv('OUTBOX_BACKOFF_BASE', 2))
+    DB_CREDENTIALS_HOOK = inject_db_credentials
+    IMPORT_TOKEN = os.getenv('IMPORT_TOKEN')
+    IMPORT_CHUNK_SIZE = int(os.getenv('IMPORT_CHUNK_SIZE', 500))
+    # imported users wait on the outbox, their tokens have to outlive the whole send
+    IMPORT_TOKEN_MINUTES = int(os.getenv('IMPORT_TOKEN_MINUTES', 7 * 24 * 60))
+    # token buckets shared by every worker on the box, rates are tokens per second
+    RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+    RATE_LIMIT_PATH = os.getenv('RATE_LIMIT_PATH', '/dev/shm/webapp-rate-limit')
+    RATE_LIMIT_IP_RATE = float(os.getenv('RATE_LIMIT_IP_RATE', 1))
+    RATE_LIMIT_IP_BURST = int(os.getenv('RATE_LIMIT_IP_BURST', 20))
+    RATE_LIMIT_ACCOUNT_RATE = float(os.getenv('RATE_LIMIT_ACCOUNT_RATE', 0.2))
+    RATE_LIMIT_ACCOUNT_BURST = int(os.getenv('RATE_LIMIT_ACCOUNT_BURST', 10))
+    PASSWORD_CHECK_CONCURRENCY = int(os.getenv('PASSWORD_CHECK_CONCURRENCY', 8))
+    TRUSTED_PROXIES = int(os.getenv('TRUSTED_PROXIES', 0))
+    # without trusted proxies behind a load balancer every client shares the balancer's IP, and one bucket with it
+    RATE_LIMIT_PER_IP = os.getenv('RATE_LIMIT_PER_IP', 'true' if TRUSTED_PROXIES else 'false').lower() == 'true'
+    LOG_FILE = os.getenv('LOG_FILE', '/var/log/webapp.log')
+    LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+    LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+    # successful requests only, errors are always logged, e.g. "HealthCheck:0.01,GetUserInfo:0.1"
+    LOG_SAMPLE_RATES = os.getenv('LOG_SAMPLE_RATES', '')
+    # "log" sends traces through the log pipeline, "file:/path" appends JSON lines, empty turns tracing off
+    TRACE_EXPORTER = os.getenv('TRACE_EXPORTER', '')
+    # "newkid:secret,oldkid:secret", the first key signs and all of them verify
+    AUTH_TOKEN_KEYS = os.getenv('AUTH_TOKEN_KEYS', '')
+    AUTH_TOKEN_TTL = int(os.getenv('AUTH_TOKEN_TTL', 900))
+
 class TestConfig:
-    SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
-    TESTING = True
\ No newline at end of file
+    SQLALCHEMY_DATABASE_URI = os.getenv('TEST_DATABASE_URI', 'sqlite:///:memory:')
+    # only for file or server databases, in-memory SQLite uses a single static connection
+    SQLALCHEMY_ENGINE_OPTIONS = {'pool_size': int(os.environ['TEST_DB_POOL_SIZE'])} if os.getenv('TEST_DB_POOL_SIZE') else {}
+    TESTING = True
+    BCRYPT_ROUNDS = 4
+    S3_BUCKET_NAME = 'test-bucket'
+    DB_HEALTH_MONITOR = False
+    OUTBOX_DISPATCHER = False
+    IMAGE_VARIANTS = False
+    RATE_LIMIT_ENABLED = False
+    AUTH_TOKEN_KEYS = 'test:test-signing-key'
@@ -0,0 +1,18 @@
+def cooperative():
+    """True under gevent's monkey-patching (gunicorn's gevent worker), where threads are greenlets."""
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('threading')
+
+def run_in_os_thread(fn, *args):
+    """Call fn on a real OS thread from gevent's hub pool when cooperative, otherwise just call it.
+
+    CPU-bound or blocking work run this way waits without stalling the other greenlets; fn must not
+    touch sockets or locks shared with them.
+    """
+    if not cooperative():
+        return fn(*args)
+    import gevent
+    return gevent.get_hub().threadpool.apply(fn, args)
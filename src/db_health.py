@@ -0,0 +1,103 @@
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError, DBAPIError
+from src.models import db
+import os
+import threading
+import time
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+# in-memory view of database health, refreshed by a background probe instead of per request
+class DBCircuitBreaker:
+    def __init__(self, failure_threshold=3, reset_timeout=5, probe_interval=5):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.probe_interval = probe_interval
+        self.app = None
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0
+        self._lock = threading.Lock()
+        self._monitor = None
+        self._monitor_pid = None
+        self._stop = threading.Event()
+
+    def init_app(self, app):
+        self.app = app
+        self.failure_threshold = app.config.get('DB_FAILURE_THRESHOLD', self.failure_threshold)
+        self.reset_timeout = app.config.get('DB_RESET_TIMEOUT', self.reset_timeout)
+        self.probe_interval = app.config.get('DB_PROBE_INTERVAL', self.probe_interval)
+
+    @property
+    def state(self):
+        return self._state
+
+    def probe(self):
+        try:
+            with self.app.app_context():
+                with db.engine.connect() as connection:
+                    connection.execute(text('SELECT 1'))
+            self.record_success()
+            return True
+        except (OperationalError, DBAPIError):
+            self.record_failure()
+            return False
+
+    def confirm_outage(self):
+        """After a query error, probe the primary; only an unreachable primary counts against the circuit.
+
+        Deadlocks, lock-wait timeouts and replica failures raise the same exception types, they must not
+        take every request on the worker down with them.
+        """
+        return not self.probe()
+
+    def record_success(self):
+        with self._lock:
+            self._state = CLOSED
+            self._failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+
+    def allow_request(self):
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            if self._state == HALF_OPEN or time.monotonic() - self._opened_at < self.reset_timeout:
+                return False
+            # this caller runs the single trial probe, everyone else keeps failing fast
+            self._state = HALF_OPEN
+        return self.probe()
+
+    def start_monitor(self):
+        # threads do not survive fork, so each worker process starts its own monitor
+        if not self.app.config.get('DB_HEALTH_MONITOR', True):
+            return
+        if self._monitor is not None and self._monitor_pid == os.getpid():
+            return
+        with self._lock:
+            if self._monitor is not None and self._monitor_pid == os.getpid():
+                return
+            self._stop.clear()
+            self._monitor = threading.Thread(target=self._run, name="db-health-monitor", daemon=True)
+            self._monitor_pid = os.getpid()
+            self._monitor.start()
+
+    def stop_monitor(self):
+        self._stop.set()
+        self._monitor = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.probe()
+            self._stop.wait(self.probe_interval)
+
+
+db_breaker = DBCircuitBreaker()
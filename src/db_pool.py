@@ -0,0 +1,37 @@
+from sqlalchemy.pool import QueuePool
+from src.metrics import log_api_call_duration, log_api_call_count, log_gauge
+import time
+
+
+# QueuePool that reports checkout wait, connections in use and overflow to statsd
+class InstrumentedQueuePool(QueuePool):
+    def _do_get(self):
+        start_time = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except Exception:
+            log_api_call_count("DBPool.checkout_failed")
+            raise
+        time_elapsed = (time.perf_counter() - start_time) * 1000
+        log_api_call_duration("DBPool.checkout_wait", time_elapsed)
+        self.report_usage()
+        return connection
+
+    def _do_return_conn(self, record):
+        super()._do_return_conn(record)
+        self.report_usage()
+
+    def report_usage(self):
+        log_gauge("DBPool.in_use", self.checkedout())
+        log_gauge("DBPool.overflow", max(self.overflow(), 0))
+
+
+def engine_options(pool_size, max_overflow, pool_timeout, pool_recycle, pool_pre_ping):
+    return {
+        "poolclass": InstrumentedQueuePool,
+        "pool_size": pool_size,
+        "max_overflow": max_overflow,
+        "pool_timeout": pool_timeout,
+        "pool_recycle": pool_recycle,
+        "pool_pre_ping": pool_pre_ping,
+    }
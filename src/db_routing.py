@@ -0,0 +1,87 @@
+from flask import g, has_request_context, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+import random
+import threading
+import time
+
+REPLICA_BIND_PREFIX = "replica"
+STICKY_COOKIE = "db_primary_until"
+
+
+# sends reads to a replica when the current request allows it, everything else to the primary
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and reads_from_replica():
+            replicas = [engine for key, engine in self._db.engines.items()
+                        if key and key.startswith(REPLICA_BIND_PREFIX)]
+            if replicas:
+                return random.choice(replicas)
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+@event.listens_for(RoutingSession, "after_flush")
+def mark_request_wrote(session, flush_context):
+    if has_request_context():
+        g.db_wrote = True
+
+
+def reads_from_replica():
+    return has_request_context() and g.get('db_read_only', False) and not g.get('db_wrote', False)
+
+
+def read_replica(f):
+    """Mark a view as read-only so its queries may be served by a replica."""
+    f.read_replica = True
+    return f
+
+
+# clients that just wrote read from the primary for a while, so they see their own writes
+class PrimaryStickiness:
+    def __init__(self, seconds=5):
+        self.seconds = seconds
+        self._until = {}
+        self._lock = threading.Lock()
+
+    def stick(self, identity):
+        until = time.time() + self.seconds
+        with self._lock:
+            self._until[identity] = until
+            if len(self._until) > 10000:
+                now = time.time()
+                self._until = {k: v for k, v in self._until.items() if v > now}
+        return until
+
+    def is_sticky(self, identity):
+        return self._until.get(identity, 0) > time.time()
+
+
+primary_stickiness = PrimaryStickiness()
+
+def client_identity():
+    auth = request.authorization
+    if auth and auth.type == 'bearer':
+        # imported here, src.auth needs the models, which need this module
+        from src.auth import get_token_signer
+        claims = get_token_signer().verify(auth.token)
+        if claims is not None:
+            return f"user:{claims['sub']}"
+    elif auth and auth.username:
+        return auth.username
+    return request.remote_addr
+
+def route_request(view_function):
+    # the cookie carries stickiness across worker processes for clients that keep it
+    try:
+        cookie_until = float(request.cookies.get(STICKY_COOKIE, 0))
+    except ValueError:
+        cookie_until = 0
+    g.db_read_only = (getattr(view_function, 'read_replica', False)
+                      and cookie_until <= time.time()
+                      and not primary_stickiness.is_sticky(client_identity()))
+
+def remember_write(response):
+    if g.get('db_wrote', False):
+        until = primary_stickiness.stick(client_identity())
+        response.set_cookie(STICKY_COOKIE, str(int(until) + 1), max_age=primary_stickiness.seconds + 1, httponly=True)
+    return response
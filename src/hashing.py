@@ -0,0 +1,112 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import deque
+import multiprocessing
+from flask import current_app
+from src.cooperative import cooperative
+import bcrypt
+import threading
+
+
+class HashPoolUnavailable(Exception):
+    pass
+
+
+# bcrypt work runs in a dedicated process pool so it never holds a request worker's GIL
+_executor = None
+_slots = None
+_rounds = 12
+_workers = 2
+_lock = threading.Lock()
+
+def _hashpw(password, rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+def _checkpw(password, hashed):
+    return bcrypt.checkpw(password, hashed)
+
+def _get_executor():
+    global _executor, _slots, _rounds, _workers
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                _workers = current_app.config.get('HASH_POOL_WORKERS', 2)
+                # jobs allowed in flight (running plus queued) before callers are turned away
+                _slots = threading.BoundedSemaphore(_workers + current_app.config.get('HASH_QUEUE_SIZE', 32))
+                _rounds = current_app.config.get('BCRYPT_ROUNDS', 12)
+                # under gevent bcrypt goes to real threads, it releases the GIL
+                if cooperative():
+                    from gevent.threadpool import ThreadPoolExecutor
+                    _executor = ThreadPoolExecutor(max_workers=_workers)
+                else:
+                    # forking a threaded worker can copy locks held by other threads into the children,
+                    # the fork server hands out children of a clean single-threaded process instead
+                    context = multiprocessing.get_context('forkserver')
+                    context.set_forkserver_preload(['bcrypt'])
+                    _executor = ProcessPoolExecutor(max_workers=_workers, mp_context=context)
+    return _executor
+
+def shutdown_hash_pool():
+    global _executor
+    with _lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+
+def discard_hash_pool():
+    # after fork the inherited executor belongs to the parent, leave it alone
+    global _executor
+    _executor = None
+
+def _submit(fn, *args):
+    executor = _get_executor()
+    if not _slots.acquire(blocking=False):
+        raise HashPoolUnavailable()
+    try:
+        future = executor.submit(fn, *args)
+    except BrokenProcessPool:
+        _slots.release()
+        shutdown_hash_pool()
+        raise HashPoolUnavailable()
+    future.add_done_callback(lambda _: _slots.release())
+    try:
+        return future.result()
+    except BrokenProcessPool:
+        shutdown_hash_pool()
+        raise HashPoolUnavailable()
+
+def hash_password(password):
+    _get_executor()
+    return _submit(_hashpw, password.encode('utf-8'), _rounds)
+
+def hash_passwords(passwords):
+    """Hash many passwords across the pool, in order.
+
+    Bulk work waits for free slots instead of failing, and keeps at most one job per worker
+    in flight so the rest of the queue stays available to request traffic.
+    """
+    executor = _get_executor()
+    in_flight = deque()
+    hashed = []
+    try:
+        for password in passwords:
+            if len(in_flight) >= _workers:
+                hashed.append(in_flight.popleft().result())
+            _slots.acquire()
+            try:
+                future = executor.submit(_hashpw, password.encode('utf-8'), _rounds)
+            except BrokenProcessPool:
+                _slots.release()
+                raise
+            future.add_done_callback(lambda _: _slots.release())
+            in_flight.append(future)
+        hashed.extend(future.result() for future in in_flight)
+    except BrokenProcessPool:
+        shutdown_hash_pool()
+        raise HashPoolUnavailable()
+    return hashed
+
+def check_password(password, hashed):
+    if(type(hashed) == str):
+        hashed = hashed.encode('utf-8')
+    return _submit(_checkpw, password.encode('utf-8'), hashed)
@@ -0,0 +1,129 @@
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from PIL import Image as PILImage, ImageOps
+from src.models import db, Image, ImageVariant
+from src.metrics import log_api_call_duration, timed
+from src.cooperative import run_in_os_thread
+from src.log_pipeline import current_request_id
+from src.tracing import tracer
+import threading
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# label -> longest edge in pixels
+DEFAULT_VARIANT_SIZES = {"thumbnail": 64, "medium": 256}
+
+PIL_FORMATS = {
+    "png": ("PNG", "image/png"),
+    "jpg": ("JPEG", "image/jpeg"),
+    "jpeg": ("JPEG", "image/jpeg"),
+}
+
+def parse_variant_sizes(value):
+    """Parse "thumbnail:64,medium:256" into {"thumbnail": 64, "medium": 256}."""
+    sizes = {}
+    for item in value.split(','):
+        if item.strip():
+            label, size = item.split(':')
+            sizes[label.strip()] = int(size)
+    return sizes
+
+def variant_key(object_name, label):
+    stem, _, extension = object_name.rpartition('.')
+    return f"{stem}_{label}.{extension}"
+
+def render_variant(original, max_edge, pil_format):
+    variant = original.copy()
+    variant.thumbnail((max_edge, max_edge))
+    if pil_format == "JPEG" and variant.mode not in ("RGB", "L"):
+        variant = variant.convert("RGB")
+    buffer = BytesIO()
+    variant.save(buffer, format=pil_format)
+    buffer.seek(0)
+    return buffer, variant.size
+
+def render_variants(body, sizes, pil_format):
+    """Decode the original once and render every size, returning [(label, buffer, (width, height))]."""
+    original = ImageOps.exif_transpose(PILImage.open(BytesIO(body)))
+    return [(label, *render_variant(original, max_edge, pil_format)) for label, max_edge in sizes.items()]
+
+
+# renders fixed-size renditions after upload, off the request path
+class VariantPipeline:
+    def __init__(self, sizes=None, workers=2):
+        self.sizes = sizes or DEFAULT_VARIANT_SIZES
+        self.workers = workers
+        self.app = None
+        self.get_s3_client = None
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app, get_s3_client):
+        self.app = app
+        self.get_s3_client = get_s3_client
+        if app.config.get('IMAGE_VARIANT_SIZES'):
+            self.sizes = parse_variant_sizes(app.config['IMAGE_VARIANT_SIZES'])
+        self.workers = app.config.get('IMAGE_VARIANT_WORKERS', self.workers)
+
+    def submit(self, image_id, bucket_name, object_name):
+        if not self.app.config.get('IMAGE_VARIANTS', True) or self.workers <= 0:
+            return None
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="image-variants")
+        return self._executor.submit(self.process, image_id, bucket_name, object_name, current_request_id())
+
+    def discard_executor(self):
+        self._executor = None
+
+    def process(self, image_id, bucket_name, object_name, request_id=None):
+        # runs on the pool, outside the upload request; its S3 and DB spans join that request's trace
+        with tracer.trace("ImageVariants", trace_id=request_id, image_id=image_id):
+            return self._process(image_id, bucket_name, object_name)
+
+    def _process(self, image_id, bucket_name, object_name):
+        start_time = time.perf_counter()
+        extension = object_name.rpartition('.')[2].lower()
+        if extension not in PIL_FORMATS:
+            return []
+        pil_format, content_type = PIL_FORMATS[extension]
+        s3_client = self.get_s3_client()
+        try:
+            with timed("S3", "S3Get", key=object_name):
+                body = s3_client.get_object(Bucket=bucket_name, Key=object_name)['Body'].read()
+            # decode and resize hold the CPU, under gevent they would stall every request on the hub
+            renditions = run_in_os_thread(render_variants, body, self.sizes, pil_format)
+            rendered = []
+            for label, buffer, (width, height) in renditions:
+                key = variant_key(object_name, label)
+                with timed("S3", "S3Put", key=key):
+                    s3_client.put_object(Bucket=bucket_name, Key=key, Body=buffer, ContentType=content_type)
+                rendered.append((label, key, width, height))
+        except Exception:
+            logger.exception("Failed to render image variants for %s", object_name)
+            return []
+
+        with self.app.app_context():
+            # the picture may have been replaced or deleted while we were rendering
+            if db.session.get(Image, image_id) is None:
+                for _, key, _, _ in rendered:
+                    with timed("S3", "S3Delete", key=key):
+                        s3_client.delete_object(Bucket=bucket_name, Key=key)
+                return []
+            variants = [
+                ImageVariant(image_id=image_id, label=label, url=f"{bucket_name}/{key}", width=width, height=height)
+                for label, key, width, height in rendered
+            ]
+            db.session.add_all(variants)
+            db.session.commit()
+            result = [variant.label for variant in variants]
+
+        time_elapsed = (time.perf_counter() - start_time) * 1000
+        log_api_call_duration("ImageVariants", time_elapsed)
+        return result
+
+
+variant_pipeline = VariantPipeline()
@@ -0,0 +1,181 @@
+from flask import g, request, has_request_context
+from logging.handlers import QueueHandler, QueueListener, WatchedFileHandler
+from src.metrics import route_metric_name, parse_sample_rates, log_count
+from src.cooperative import cooperative
+from _queue import SimpleQueue
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+
+REQUEST_ID_HEADER = 'X-Request-ID'
+# ids passed in by the load balancer or client are kept if they look sane
+_REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+access_logger = logging.getLogger('webapp.access')
+
+
+def current_request_id():
+    """The id of the request being served, or None outside one; background work carries it along."""
+    return g.get('request_id') if has_request_context() else None
+
+
+class JsonFormatter(logging.Formatter):
+    # runs on the listener thread, off the request path
+    def format(self, record):
+        entry = {
+            # same layout the CloudWatch agent's timestamp_format expects
+            'time': self.formatTime(record, '%Y-%m-%d %H:%M:%S'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in ('request_id', 'route'):
+            value = getattr(record, field, None)
+            if value:
+                entry[field] = value
+        entry.update(getattr(record, 'fields', None) or {})
+        return json.dumps(entry, default=str)
+
+
+class RequestContextQueueHandler(QueueHandler):
+    """Tags records with the request id on the caller's thread, then hands them to the listener.
+
+    A full queue drops the record instead of blocking the request.
+    """
+
+    def __init__(self, pipeline):
+        super().__init__(None)
+        self.pipeline = pipeline
+
+    def prepare(self, record):
+        if has_request_context():
+            record.request_id = g.get('request_id')
+            record.route = route_metric_name(request.endpoint)
+        return super().prepare(record)
+
+    def enqueue(self, record):
+        try:
+            self.pipeline.queue().put_nowait(record)
+        except queue.Full:
+            log_count("Logging.dropped", 1)
+
+
+class _OsThreadQueue:
+    """Bounded queue shared by greenlets and an OS thread; the C SimpleQueue takes no patchable lock."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._queue = SimpleQueue()
+
+    def put_nowait(self, record):
+        if self._queue.qsize() >= self.maxsize:
+            raise queue.Full
+        self._queue.put(record)
+
+    def put(self, record):
+        self._queue.put(record)
+
+    def get(self, block=True, timeout=None):
+        return self._queue.get(block, timeout)
+
+
+class OsThreadQueueListener(QueueListener):
+    """Under gevent the listener thread would be a greenlet, and its disk writes would block the hub.
+
+    This one writes from a single OS thread of gevent's native pool instead.
+    """
+
+    def start(self):
+        from gevent.threadpool import ThreadPool
+        self._pool = ThreadPool(1)
+        self._thread = self._pool.spawn(self._monitor)
+
+    def enqueue_sentinel(self):
+        # never dropped, a full queue must not leave stop() waiting
+        self.queue.put(self._sentinel)
+
+    def stop(self):
+        self.enqueue_sentinel()
+        self._thread.get()
+        self._pool.kill()
+        self._thread = None
+
+
+class LogPipeline:
+    def __init__(self, queue_size=10000):
+        self.queue_size = queue_size
+        self.sample_rates = {}
+        self.handler = None
+        self.target = None
+        self._queue = None
+        self._listener = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.queue_size = app.config.get('LOG_QUEUE_SIZE', self.queue_size)
+        self.sample_rates = parse_sample_rates(app.config.get('LOG_SAMPLE_RATES'))
+        log_file = app.config.get('LOG_FILE')
+        # WatchedFileHandler reopens the file after logrotate moves it
+        self.target = WatchedFileHandler(log_file, delay=True) if log_file else logging.StreamHandler(sys.stderr)
+        self.target.setFormatter(JsonFormatter())
+        self.handler = RequestContextQueueHandler(self)
+        root = logging.getLogger()
+        root.setLevel(app.config.get('LOG_LEVEL', 'INFO'))
+        root.addHandler(self.handler)
+        atexit.register(self.stop)
+
+    def queue(self):
+        # one queue and writer thread per process, a forked worker starts its own
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    if cooperative():
+                        self._queue = _OsThreadQueue(self.queue_size)
+                        self._listener = OsThreadQueueListener(self._queue, self.target, respect_handler_level=True)
+                    else:
+                        self._queue = queue.Queue(self.queue_size)
+                        self._listener = QueueListener(self._queue, self.target, respect_handler_level=True)
+                    self._listener.start()
+                    self._pid = os.getpid()
+        return self._queue
+
+    def start_request(self):
+        request_id = request.headers.get(REQUEST_ID_HEADER, '')
+        g.request_id = request_id if _REQUEST_ID_PATTERN.match(request_id) else uuid.uuid4().hex
+        g.log_start = time.perf_counter()
+
+    def finish_request(self, response):
+        """Write one access record per request; successful ones are sampled per route, failures always kept."""
+        if 'request_id' not in g:
+            return response
+        response.headers[REQUEST_ID_HEADER] = g.request_id
+        route = route_metric_name(request.endpoint)
+        if response.status_code < 400 and random.random() >= self.sample_rates.get(route, 1):
+            return response
+        access_logger.info("%s %s %s", request.method, request.path, response.status_code, extra={'fields': {
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'duration_ms': round((time.perf_counter() - g.log_start) * 1000, 2),
+        }})
+        return response
+
+    def stop(self):
+        # flushes what is queued, for shutdown and tests
+        with self._lock:
+            if self._listener is not None and self._pid == os.getpid():
+                self._listener.stop()
+            self._listener = None
+            self._pid = None
+
+
+log_pipeline = LogPipeline()
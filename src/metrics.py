@@ -1,12 +1,106 @@
 from statsd import StatsClient
+from flask import g, has_request_context, request
+from contextlib import contextmanager
+from src.tracing import tracer
 import time
 
-statsd_client = StatsClient(host="localhost", port=8125, prefix="WebAppMetrics")
+# large enough that one request's metrics usually go out as a single packet
+statsd_client = StatsClient(host="localhost", port=8125, prefix="WebAppMetrics", maxudpsize=1400)
+
+# route metric name -> statsd sample rate, for high-volume routes
+route_sample_rates = {}
+
+
+def _client():
+    # inside a request everything is buffered and flushed once at teardown
+    if has_request_context():
+        pipeline = g.get('metrics_pipeline')
+        if pipeline is not None:
+            return pipeline
+    return statsd_client
 
 
 def log_api_call_count(api_name):
-    statsd_client.incr(f"{api_name}.count")
+    _client().incr(f"{api_name}.count")
 
 
 def log_api_call_duration(api_name, duration_ms):
-    statsd_client.timing(f"{api_name}.duration", duration_ms)
+    _client().timing(f"{api_name}.duration", duration_ms)
+
+
+def log_count(metric_name, count):
+    _client().incr(metric_name, count)
+
+
+def log_cache_event(cache_name, event):
+    _client().incr(f"{cache_name}.{event}")
+
+
+def log_gauge(metric_name, value):
+    _client().gauge(metric_name, value)
+
+
+def parse_sample_rates(value):
+    """Parse "HealthCheck:0.1,GetUserInfo:0.5" into {"HealthCheck": 0.1, "GetUserInfo": 0.5}."""
+    rates = {}
+    for item in (value or '').split(','):
+        if item.strip():
+            route, rate = item.split(':')
+            rates[route.strip()] = float(rate)
+    return rates
+
+
+def route_metric_name(endpoint):
+    # create_user -> CreateUser, matching the names the handlers used to log by hand
+    if not endpoint:
+        return None
+    return ''.join(part.capitalize() for part in endpoint.split('_'))
+
+
+def record_timing(component, duration_ms):
+    if has_request_context() and 'metrics_timings' in g:
+        g.metrics_timings[component] = g.metrics_timings.get(component, 0) + duration_ms
+
+
+@contextmanager
+def timed(component, metric_name=None, **attributes):
+    """Time a block as a DB/S3/SNS sub-timing of the current request, error paths included.
+
+    The block is also a trace span, named after the metric.
+    """
+    start_time = time.perf_counter()
+    try:
+        with tracer.span(metric_name or component, component=component, **attributes):
+            yield
+    finally:
+        time_elapsed = (time.perf_counter() - start_time) * 1000
+        record_timing(component, time_elapsed)
+        if metric_name:
+            log_api_call_duration(metric_name, time_elapsed)
+
+
+def start_request_metrics():
+    g.metrics_pipeline = statsd_client.pipeline()
+    g.metrics_timings = {}
+    g.metrics_status = 500
+    g.metrics_start = time.perf_counter()
+
+
+def set_request_status(status_code):
+    g.metrics_status = status_code
+
+
+def finish_request_metrics():
+    pipeline = g.pop('metrics_pipeline', None)
+    if pipeline is None:
+        return
+    route = route_metric_name(request.endpoint)
+    if route:
+        rate = route_sample_rates.get(route, 1)
+        time_elapsed = (time.perf_counter() - g.metrics_start) * 1000
+        pipeline.incr(f"{route}.count", rate=rate)
+        pipeline.timing(f"{route}.duration", time_elapsed, rate=rate)
+        pipeline.incr(f"{route}.status.{g.metrics_status}", rate=rate)
+        for component, duration_ms in g.metrics_timings.items():
+            pipeline.timing(f"{route}{component}.duration", duration_ms, rate=rate)
+    pipeline.send()
@@ -0,0 +1,170 @@
+from datetime import datetime
+from sqlalchemy import (MetaData, Table, Column, String, DateTime, Integer, Boolean, ForeignKey,
+                        inspect, text)
+from sqlalchemy.dialects.mysql import TINYINT
+from src.models import EmailOutbox, ImageVariant
+
+# versioned schema changes, applied in order and recorded in schema_migrations
+MIGRATIONS = []
+
+def migration(version, name):
+    def register(fn):
+        MIGRATIONS.append((version, name, fn))
+        return fn
+    return register
+
+
+def _is_boolean(column_type):
+    # MySQL reflects BOOLEAN as TINYINT(1)
+    return isinstance(column_type, (Boolean, TINYINT))
+
+
+def _has_index(connection, table, index_name):
+    inspector = inspect(connection)
+    indexes = inspector.get_indexes(table) + inspector.get_unique_constraints(table)
+    return any(index['name'] == index_name for index in indexes)
+
+
+@migration(1, "initial_schema")
+def initial_schema(connection):
+    # the users and images tables as db.create_all() used to create them
+    metadata = MetaData()
+    Table('users', metadata,
+          Column('id', String(36), primary_key=True),
+          Column('email', String(120), unique=True, nullable=False),
+          Column('password', String(128), nullable=False),
+          Column('first_name', String(50)),
+          Column('last_name', String(50)),
+          Column('account_created', DateTime),
+          Column('account_updated', DateTime),
+          Column('is_verified', String(5), nullable=False),
+          Column('verification_token', String(255)),
+          Column('token_expiration', DateTime))
+    Table('images', metadata,
+          Column('id', String(36), primary_key=True),
+          Column('file_name', String(255), nullable=False),
+          Column('url', String(255), nullable=False),
+          Column('upload_date', DateTime, nullable=False),
+          Column('user_id', String(36), ForeignKey('users.id'), nullable=False))
+    metadata.create_all(connection, checkfirst=True)
+
+
+@migration(2, "email_outbox")
+def email_outbox(connection):
+    EmailOutbox.__table__.create(connection, checkfirst=True)
+
+
+@migration(3, "image_variants")
+def image_variants(connection):
+    ImageVariant.__table__.create(connection, checkfirst=True)
+
+
+@migration(4, "index_verification_token")
+def index_verification_token(connection):
+    # verify_user looks users up by token
+    if not _has_index(connection, 'users', 'ix_users_verification_token'):
+        connection.execute(text("CREATE INDEX ix_users_verification_token ON users (verification_token)"))
+
+
+@migration(5, "is_verified_boolean")
+def is_verified_boolean(connection):
+    # "True"/"False" strings become a one-byte boolean. Each MySQL DDL statement commits on its own,
+    # so every step checks what an interrupted earlier run already did.
+    columns = {column['name']: column for column in inspect(connection).get_columns('users')}
+    legacy = 'is_verified' in columns and not _is_boolean(columns['is_verified']['type'])
+    if 'is_verified_flag' not in columns:
+        if not legacy:
+            return
+        connection.execute(text("ALTER TABLE users ADD COLUMN is_verified_flag BOOLEAN NOT NULL DEFAULT 0"))
+    if legacy:
+        connection.execute(text("UPDATE users SET is_verified_flag = 1 WHERE is_verified = 'True'"))
+        connection.execute(text("ALTER TABLE users DROP COLUMN is_verified"))
+    connection.execute(text("ALTER TABLE users RENAME COLUMN is_verified_flag TO is_verified"))
+
+
+@migration(6, "unique_image_user")
+def unique_image_user(connection):
+    if _has_index(connection, 'images', 'uq_images_user_id'):
+        return
+    # keep only the newest picture per user before enforcing one picture per user
+    duplicates = connection.execute(text(
+        "SELECT id FROM images i WHERE EXISTS ("
+        " SELECT 1 FROM images newer WHERE newer.user_id = i.user_id"
+        " AND (newer.upload_date > i.upload_date OR (newer.upload_date = i.upload_date AND newer.id > i.id)))"
+    )).scalars().all()
+    for image_id in duplicates:
+        connection.execute(text("DELETE FROM image_variants WHERE image_id = :id"), {"id": image_id})
+        connection.execute(text("DELETE FROM images WHERE id = :id"), {"id": image_id})
+    connection.execute(text("CREATE UNIQUE INDEX uq_images_user_id ON images (user_id)"))
+
+
+@migration(7, "index_token_expiration")
+def index_token_expiration(connection):
+    # the unverified-user reaper scans by expiry
+    if not _has_index(connection, 'users', 'ix_users_token_expiration'):
+        connection.execute(text("CREATE INDEX ix_users_token_expiration ON users (token_expiration)"))
+
+
+@migration(8, "user_token_version")
+def user_token_version(connection):
+    # bumped on password change, bearer tokens carrying an older version are revoked
+    columns = {column['name'] for column in inspect(connection).get_columns('users')}
+    if 'token_version' not in columns:
+        connection.execute(text("ALTER TABLE users ADD COLUMN token_version INTEGER NOT NULL DEFAULT 0"))
+
+
+
+@migration(9, "user_account_updated_microseconds")
+def user_account_updated_microseconds(connection):
+    # the user ETag comes from account_updated, it needs sub-second precision; SQLite keeps it already
+    if connection.dialect.name != 'mysql':
+        return
+    columns = {column['name']: column for column in inspect(connection).get_columns('users')}
+    if getattr(columns['account_updated']['type'], 'fsp', None) != 6:
+        connection.execute(text("ALTER TABLE users MODIFY account_updated DATETIME(6) NULL"))
+
+
+@migration(10, "outbox_request_id")
+def outbox_request_id(connection):
+    # the dispatcher traces each publish under the request that queued the message
+    columns = {column['name'] for column in inspect(connection).get_columns('email_outbox')}
+    if 'request_id' not in columns:
+        connection.execute(text("ALTER TABLE email_outbox ADD COLUMN request_id VARCHAR(64)"))
+
+schema_migrations = Table(
+    'schema_migrations', MetaData(),
+    Column('version', Integer, primary_key=True, autoincrement=False),
+    Column('name', String(100), nullable=False),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+
+def run_migrations(engine):
+    """Apply pending migrations and return their names.
+
+    Runs as a deploy step (`flask migrate`), never inside a request. Each migration gets its own
+    transaction, but MySQL commits every DDL statement implicitly, so migrations must be safe to
+    rerun from wherever an earlier attempt stopped.
+    """
+    applied = []
+    with engine.connect() as lock_connection:
+        # several workers may start at once, MySQL serialises them on a named lock
+        if engine.dialect.name == 'mysql':
+            lock_connection.execute(text("SELECT GET_LOCK('webapp_migrations', 60)"))
+        try:
+            with engine.begin() as connection:
+                schema_migrations.create(connection, checkfirst=True)
+                done = set(connection.execute(schema_migrations.select().with_only_columns(
+                    schema_migrations.c.version)).scalars())
+            for version, name, fn in sorted(MIGRATIONS, key=lambda m: m[0]):
+                if version in done:
+                    continue
+                with engine.begin() as connection:
+                    fn(connection)
+                    connection.execute(schema_migrations.insert().values(
+                        version=version, name=name, applied_at=datetime.now()))
+                applied.append(name)
+        finally:
+            if engine.dialect.name == 'mysql':
+                lock_connection.execute(text("SELECT RELEASE_LOCK('webapp_migrations')"))
+    return applied
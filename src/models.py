@@ -1,9 +1,16 @@
 import uuid
 from datetime import datetime
-from sqlalchemy import Column, String, DateTime
+from sqlalchemy import Column, String, DateTime, Integer, Text, Boolean
+from sqlalchemy.dialects import mysql
 from flask_sqlalchemy import SQLAlchemy
+from src.db_routing import RoutingSession
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={"class_": RoutingSession})
+
+EMAIL_REGEX = r'^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$'
+
+# MySQL's DATETIME drops fractions, two updates in one second would share an ETag
+PreciseDateTime = DateTime().with_variant(mysql.DATETIME(fsp=6), 'mysql')
 
 class User(db.Model):
     __tablename__ = 'users'
@@ -13,18 +20,49 @@ class User(db.Model):
     password = Column(String(128), nullable=False)
     first_name = Column(String(50))
     last_name = Column(String(50))
-    account_created = Column(DateTime, default=datetime.now())
-    account_updated = Column(DateTime, default=datetime.now(), onupdate=datetime.now())
+    account_created = Column(DateTime, default=datetime.now)
+    account_updated = Column(PreciseDateTime, default=datetime.now, onupdate=datetime.now)
+
+    is_verified = Column(Boolean, nullable=False, default=False)
+    verification_token = Column(String(255), nullable=True, index=True)
+    token_expiration = Column(DateTime, nullable=True, index=True)
+    token_version = Column(Integer, nullable=False, default=0, server_default='0')
 
-    is_verified = Column(String(5), nullable=False, default="False")
-    verification_token = Column(String(255), nullable=True)
-    token_expiration = Column(DateTime, nullable=True)
+    image = db.relationship('Image', uselist=False, back_populates='user')
 
 class Image(db.Model):
     __tablename__ = 'images'
+    __table_args__ = (db.Index('uq_images_user_id', 'user_id', unique=True),)
 
     id = Column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
     file_name = Column(String(255), nullable=False)
     url = Column(String(255), nullable=False)
-    upload_date = Column(DateTime, default=datetime.now(), nullable=False)
-    user_id = Column(String(36), db.ForeignKey('users.id'), nullable=False)
\ No newline at end of file
+    upload_date = Column(DateTime, default=datetime.now, nullable=False)
+    user_id = Column(String(36), db.ForeignKey('users.id'), nullable=False)
+
+    user = db.relationship('User', back_populates='image')
+    variants = db.relationship('ImageVariant', cascade='all, delete-orphan', back_populates='image')
+
+class ImageVariant(db.Model):
+    __tablename__ = 'image_variants'
+
+    id = Column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    image_id = Column(String(36), db.ForeignKey('images.id', ondelete='CASCADE'), nullable=False, index=True)
+    label = Column(String(20), nullable=False)
+    url = Column(String(255), nullable=False)
+    width = Column(Integer, nullable=False)
+    height = Column(Integer, nullable=False)
+
+    image = db.relationship('Image', back_populates='variants')
+
+class EmailOutbox(db.Model):
+    __tablename__ = 'email_outbox'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    payload = Column(Text, nullable=False)
+    status = Column(String(10), nullable=False, default="pending", index=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, nullable=False, default=datetime.now)
+    created_at = Column(DateTime, nullable=False, default=datetime.now)
+    # the sign-up request that queued it, so the background publish joins that request's trace
+    request_id = Column(String(64), nullable=True)
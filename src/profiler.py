@@ -0,0 +1,120 @@
+from collections import Counter
+from flask import g, request
+from src.cooperative import cooperative
+import hmac
+import os
+import sys
+import threading
+import time
+
+
+# samples the stacks of slow requests and writes them as collapsed stacks for flame graphs; under gevent it
+# samples parked greenlets, so it shows where a slow request waits but not a stretch of CPU that starves the hub
+class SlowRequestProfiler:
+    def __init__(self, threshold_ms=500, interval_ms=5, output_path='/tmp/webapp-profile.folded'):
+        self.enabled = False
+        self.token = None
+        self.threshold_ms = threshold_ms
+        self.interval_ms = interval_ms
+        self.output_path = output_path
+        self._active = {}
+        self._lock = threading.Lock()
+        self._sampler = None
+        self._sampler_pid = None
+        self._cooperative = False
+        # set while any request is being profiled, the sampler sleeps on it otherwise
+        self._wake = threading.Event()
+
+    def init_app(self, app):
+        self.enabled = app.config.get('PROFILER_ENABLED', False)
+        self.token = app.config.get('PROFILER_TOKEN')
+        self.threshold_ms = app.config.get('PROFILER_THRESHOLD_MS', self.threshold_ms)
+        self.interval_ms = app.config.get('PROFILER_INTERVAL_MS', self.interval_ms)
+        self.output_path = app.config.get('PROFILER_OUTPUT', self.output_path)
+
+    def wants_request(self):
+        if self.enabled:
+            return True
+        header = request.headers.get('X-Profile')
+        return bool(self.token and header and hmac.compare_digest(header, self.token))
+
+    def start_request(self):
+        # cheap exit when profiling is off: one attribute check and one header lookup
+        if not self.wants_request():
+            return
+        self._ensure_sampler()
+        samples = Counter()
+        g.profiler_samples = samples
+        with self._lock:
+            self._active[self._current()] = (time.perf_counter(), samples)
+            self._wake.set()
+
+    def finish_request(self):
+        samples = g.pop('profiler_samples', None)
+        if samples is None:
+            return
+        with self._lock:
+            self._active.pop(self._current(), None)
+        if samples:
+            self.write(f"{request.method} {request.path}", samples)
+
+    def write(self, root, samples):
+        lines = ''.join(f"{root};{stack} {count}\n" for stack, count in samples.items())
+        with self._lock:
+            with open(self.output_path, 'a') as output:
+                output.write(lines)
+
+    def _ensure_sampler(self):
+        if self._sampler is not None and self._sampler_pid == os.getpid():
+            return
+        with self._lock:
+            if self._sampler is not None and self._sampler_pid == os.getpid():
+                return
+            self._cooperative = cooperative()
+            self._wake = threading.Event()
+            self._sampler = threading.Thread(target=self._run, name="slow-request-profiler", daemon=True)
+            self._sampler_pid = os.getpid()
+            self._sampler.start()
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            time.sleep(self.interval_ms / 1000)
+            with self._lock:
+                if not self._active:
+                    # parked until the next profiled request, an idle worker pays no wake-ups
+                    self._wake.clear()
+                    continue
+                now = time.perf_counter()
+                frames = self._frames()
+                for thread_id, (started, samples) in self._active.items():
+                    # only requests that are already over the threshold get sampled
+                    if (now - started) * 1000 < self.threshold_ms or thread_id not in frames:
+                        continue
+                    samples[collapse_stack(frames[thread_id])] += 1
+
+
+    def _current(self):
+        # greenlets all run on one OS thread, their ids never show up in sys._current_frames()
+        if self._cooperative:
+            from gevent import getcurrent
+            return getcurrent()
+        return threading.get_ident()
+
+    def _frames(self):
+        if not self._cooperative:
+            return sys._current_frames()
+        # the sampler only runs while request greenlets are parked, each keeps its stack in gr_frame
+        return {task: task.gr_frame for task in self._active if task.gr_frame is not None}
+
+
+def collapse_stack(frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ';'.join(reversed(stack))
+
+
+profiler = SlowRequestProfiler()
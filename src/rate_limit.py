@@ -0,0 +1,156 @@
+from contextlib import contextmanager
+from flask import request
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+from src.metrics import log_count
+
+# one bucket per slot: key digest, tokens left, last refill (epoch seconds)
+_SLOT = struct.Struct('<Qdd')
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after=1):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+
+class SharedTokenBuckets:
+    """Token buckets kept in a shared mmap'd file, so every worker process on the box sees the same counts.
+
+    The table is direct-mapped: keys that collide share one bucket, so a collision can only tighten
+    a limit, never refill it (account keys come from clients, colliding ones are cheap to find).
+    Updates are serialised by an fcntl lock on byte 0, which the kernel drops if a worker dies holding it.
+    """
+
+    def __init__(self, path, slots=65536):
+        self.path = path
+        self.slots = slots
+        self._pid = None
+        self._fd = None
+        self._map = None
+        self._lock = threading.Lock()
+        self._open_lock = threading.Lock()
+        # fcntl locks belong to the process, so threads of one worker track the slots they hold here
+        self._held = set()
+
+    def _open(self):
+        # per process: fcntl locks and thread locks do not carry over a fork
+        if self._pid != os.getpid():
+            with self._open_lock:
+                if self._pid != os.getpid():
+                    self._lock = threading.Lock()
+                    self._held = set()
+                    self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+                    size = self.slots * _SLOT.size
+                    if os.fstat(self._fd).st_size < size:
+                        os.ftruncate(self._fd, size)
+                    self._map = mmap.mmap(self._fd, size)
+                    self._pid = os.getpid()
+        return self._fd
+
+    def _slot(self, key):
+        digest = int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little')
+        return digest, (digest % self.slots) * _SLOT.size
+
+    def take(self, key, rate, burst, now=None):
+        """Take one token for key; returns 0 when allowed, else the seconds until a token is due."""
+        digest, offset = self._slot(key)
+        fd = self._open()
+        now = now or time.time()
+        with self._lock:
+            fcntl.lockf(fd, fcntl.LOCK_EX, 1, 0)
+            try:
+                _, tokens, updated = _SLOT.unpack_from(self._map, offset)
+                tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+                if tokens >= 1:
+                    _SLOT.pack_into(self._map, offset, digest, tokens - 1, now)
+                    return 0
+                _SLOT.pack_into(self._map, offset, digest, tokens, now)
+                return (1 - tokens) / rate
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN, 1, 0)
+
+    def acquire_slot(self, limit):
+        """Hold one of `limit` box-wide slots, returning its index or None when all are taken.
+
+        Slot i is an fcntl lock on byte i + 1 of the same file, so a crashed worker's slots free themselves.
+        """
+        fd = self._open()
+        with self._lock:
+            for index in range(limit):
+                if index in self._held:
+                    continue
+                try:
+                    fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, index + 1)
+                except OSError:
+                    continue
+                self._held.add(index)
+                return index
+        return None
+
+    def release_slot(self, index):
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, index + 1)
+            self._held.discard(index)
+
+
+class AdmissionControl:
+    """Sheds password work before it reaches bcrypt: per-IP and per-account buckets plus a box-wide cap."""
+
+    def __init__(self):
+        self.enabled = False
+        self.per_ip = False
+        self.buckets = None
+        self.ip_rate, self.ip_burst = 1.0, 20
+        self.account_rate, self.account_burst = 0.2, 10
+        self.concurrency = 8
+
+    def init_app(self, app):
+        self.enabled = app.config.get('RATE_LIMIT_ENABLED', True)
+        self.per_ip = app.config.get('RATE_LIMIT_PER_IP', bool(app.config.get('TRUSTED_PROXIES')))
+        self.buckets = SharedTokenBuckets(app.config.get('RATE_LIMIT_PATH', '/dev/shm/webapp-rate-limit'),
+                                          app.config.get('RATE_LIMIT_SLOTS', 65536))
+        self.ip_rate = app.config.get('RATE_LIMIT_IP_RATE', self.ip_rate)
+        self.ip_burst = app.config.get('RATE_LIMIT_IP_BURST', self.ip_burst)
+        self.account_rate = app.config.get('RATE_LIMIT_ACCOUNT_RATE', self.account_rate)
+        self.account_burst = app.config.get('RATE_LIMIT_ACCOUNT_BURST', self.account_burst)
+        self.concurrency = app.config.get('PASSWORD_CHECK_CONCURRENCY', self.concurrency)
+
+    def admit(self, account):
+        """Charge the account, and the client IP when it is known, one token each.
+
+        Raises RateLimited when either bucket is empty.
+        """
+        if not self.enabled:
+            return
+        scopes = [('account', account, self.account_rate, self.account_burst)]
+        if self.per_ip:
+            scopes.insert(0, ('ip', request.remote_addr or '-', self.ip_rate, self.ip_burst))
+        for scope, key, rate, burst in scopes:
+            wait = self.buckets.take(f"{scope}:{key}", rate, burst)
+            if wait:
+                log_count(f"RateLimit.{scope}", 1)
+                raise RateLimited(max(1, int(wait + 0.999)))
+
+    @contextmanager
+    def password_work(self):
+        """Hold a box-wide slot around a bcrypt call, raising RateLimited when all are busy."""
+        if not self.enabled:
+            yield
+            return
+        slot = self.buckets.acquire_slot(self.concurrency)
+        if slot is None:
+            log_count("RateLimit.concurrency", 1)
+            raise RateLimited(1)
+        try:
+            yield
+        finally:
+            self.buckets.release_slot(slot)
+
+
+admission = AdmissionControl()
@@ -0,0 +1,33 @@
+from datetime import datetime
+from src.models import db, User
+from src.metrics import log_count
+import time
+
+
+def reap_expired_users(batch_size=500, pause_seconds=0.1, max_batches=None, now=None):
+    """Delete unverified users whose verification token expired, in small committed batches.
+
+    Each batch is a short transaction and batches are spaced by pause_seconds, so the job never
+    holds row locks for long. Returns how many users were removed.
+    """
+    now = now or datetime.now()
+    removed = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        ids = [row.id for row in db.session.query(User.id)
+               .filter(User.is_verified.is_(False), User.token_expiration < now)
+               .limit(batch_size)]
+        if not ids:
+            break
+        # re-check the condition, the user may have re-registered since the select
+        deleted = (User.query
+                   .filter(User.id.in_(ids), User.is_verified.is_(False), User.token_expiration < now)
+                   .delete(synchronize_session=False))
+        db.session.commit()
+        removed += deleted
+        batches += 1
+        log_count("UnverifiedReaper.deleted", deleted)
+        if len(ids) < batch_size:
+            break
+        time.sleep(pause_seconds)
+    return removed
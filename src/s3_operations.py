@@ -2,6 +2,9 @@ import boto3
 from metrics import send_custom_metric
 from config import Config
 import time
+import logging
+
+logger = logging.getLogger(__name__)
 
 s3_client = boto3.client('s3', region_name=Config.AWS_REGION)
 
@@ -9,8 +12,8 @@ def upload_file_to_s3(file_name, bucket, object_name=None):
     start_time = time.time()
     try:
         s3_client.upload_file(file_name, bucket, object_name or file_name)
-    except Exception as e:
-        print(e)
+    except Exception:
+        logger.exception("S3 upload of %s failed", object_name or file_name)
         return False
 
     elapsed = (time.time() - start_time) * 1000
@@ -1,21 +1,150 @@
 import boto3
 import json
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
 from src.config import Config
+from src.models import db, EmailOutbox
+from src.metrics import log_gauge, timed
+from src.log_pipeline import current_request_id
+from src.tracing import tracer
 
-sns_client = boto3.client(
-    "sns",
-    region_name=Config.AWS_REGION,
-    aws_access_key_id=Config.AWS_ACCESS_KEY_ID,
-    aws_secret_access_key=Config.AWS_SECRET_ACCESS_KEY,
-)
+logger = logging.getLogger(__name__)
 
-def send_verification_email(email, verification_token):
-    topic_arn = Config.SNS_TOPIC_ARN
+sns_client = None
+_sns_client_lock = threading.Lock()
+
+def get_sns_client():
+    global sns_client
+    if sns_client is None:
+        with _sns_client_lock:
+            if sns_client is None:
+                sns_client = boto3.client(
+                    "sns",
+                    region_name=Config.AWS_REGION,
+                    endpoint_url=Config.SNS_ENDPOINT_URL,
+                    aws_access_key_id=Config.AWS_ACCESS_KEY_ID,
+                    aws_secret_access_key=Config.AWS_SECRET_ACCESS_KEY,
+                )
+    return sns_client
+
+# SNS accepts at most 10 entries per publish_batch call
+SNS_BATCH_LIMIT = 10
+
+def build_verification_message(email, verification_token):
     base_url = Config.BASE_URL
     verification_link = f"{base_url}/v1/user/verify?token={verification_token}"
-    message = {"email": email, "verification_link": verification_link}
-    try:
-        response = sns_client.publish(TopicArn=topic_arn, Message=json.dumps(message))
-        print(f"SNS message sent: {response['MessageId']}")
-    except Exception as e:
-        print(f"Failed to send SNS message: {e}")
+    return json.dumps({"email": email, "verification_link": verification_link})
+
+def queue_verification_email(email, verification_token):
+    # added to the caller's session, so it is committed together with the user row
+    message = EmailOutbox(payload=build_verification_message(email, verification_token),
+                          request_id=current_request_id())
+    db.session.add(message)
+    return message
+
+
+# drains the outbox in the background with batched publishes, retries and backoff
+class OutboxDispatcher:
+    def __init__(self, batch_size=SNS_BATCH_LIMIT, poll_interval=2, max_attempts=5, backoff_base=2):
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.app = None
+        self.sns_client = None
+        self._thread = None
+        self._thread_pid = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+
+    def init_app(self, app, client=None):
+        self.app = app
+        self.batch_size = min(app.config.get('OUTBOX_BATCH_SIZE', self.batch_size), SNS_BATCH_LIMIT)
+        self.poll_interval = app.config.get('OUTBOX_POLL_INTERVAL', self.poll_interval)
+        self.max_attempts = app.config.get('OUTBOX_MAX_ATTEMPTS', self.max_attempts)
+        self.backoff_base = app.config.get('OUTBOX_BACKOFF_BASE', self.backoff_base)
+        if client is not None:
+            self.sns_client = client
+
+    def notify(self):
+        self._wakeup.set()
+
+    def start(self):
+        if not self.app.config.get('OUTBOX_DISPATCHER', True):
+            return
+        if self._thread is not None and self._thread_pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread_pid == os.getpid():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="sns-outbox-dispatcher", daemon=True)
+            self._thread_pid = os.getpid()
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                while self.drain() == self.batch_size:
+                    pass
+            except Exception:
+                logger.exception("SNS outbox dispatch failed")
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+    def backoff(self, attempts):
+        return timedelta(seconds=self.backoff_base ** attempts)
+
+    def drain(self):
+        """Publish one batch of due messages, returns how many were attempted."""
+        with self.app.app_context():
+            now = datetime.now()
+            messages = (EmailOutbox.query
+                        .filter(EmailOutbox.status == "pending", EmailOutbox.next_attempt_at <= now)
+                        .order_by(EmailOutbox.id)
+                        .limit(self.batch_size)
+                        .with_for_update(skip_locked=True)
+                        .all())
+            log_gauge("SNSOutbox.depth", EmailOutbox.query.filter_by(status="pending").count())
+            if not messages:
+                db.session.commit()
+                return 0
+
+            # a sign-up wakes the dispatcher right after its commit, so a batch usually holds one request's
+            # message and joins that trace; a mixed batch gets its own trace listing the requests it serves
+            request_ids = sorted({message.request_id for message in messages if message.request_id})
+            with tracer.trace("SNSOutboxDrain", trace_id=request_ids[0] if len(request_ids) == 1 else None,
+                              request_ids=request_ids, messages=len(messages)):
+                entries = [{'Id': str(message.id), 'Message': message.payload} for message in messages]
+                try:
+                    with timed("SNS", "SNSPublishBatch"):
+                        client = self.sns_client or get_sns_client()
+                        response = client.publish_batch(TopicArn=Config.SNS_TOPIC_ARN,
+                                                        PublishBatchRequestEntries=entries)
+                    succeeded = {entry['Id'] for entry in response.get('Successful', [])}
+                except Exception:
+                    logger.exception("Failed to publish SNS batch")
+                    succeeded = set()
+
+                for message in messages:
+                    if str(message.id) in succeeded:
+                        db.session.delete(message)
+                        continue
+                    message.attempts += 1
+                    if message.attempts >= self.max_attempts:
+                        message.status = "failed"
+                    else:
+                        message.next_attempt_at = now + self.backoff(message.attempts)
+                db.session.commit()
+            return len(messages)
+
+
+outbox_dispatcher = OutboxDispatcher()
@@ -0,0 +1,94 @@
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from contextlib import contextmanager
+from src.metrics import record_timing, route_metric_name, log_count
+from src.tracing import tracer
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# per-request statement budget, going over it usually means an N+1 query pattern
+query_budget = 10
+comment_tags = True
+
+_captures = []
+_captures_lock = threading.Lock()
+
+
+@contextmanager
+def capture_queries():
+    """Collect every statement executed inside the block, for asserting query counts in tests."""
+    statements = []
+    with _captures_lock:
+        _captures.append(statements)
+    try:
+        yield statements
+    finally:
+        with _captures_lock:
+            _captures.remove(statements)
+
+
+@event.listens_for(Engine, "before_cursor_execute", retval=True)
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+    conn.info.setdefault('query_span', []).append(tracer.start_span("DBQuery", statement=statement[:200]))
+    if has_request_context() and request.endpoint:
+        # shows up next to the statement in the MySQL slow-query log; PyMySQL only batches an
+        # executemany INSERT into one multi-row statement when it ends in its VALUES clause
+        if comment_tags and not executemany:
+            statement = f"{statement} /* route={request.endpoint} */"
+        g.sql_queries = g.get('sql_queries', 0) + 1
+    return statement, parameters
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start_time = conn.info['query_start'].pop()
+    tracer.end_span(conn.info['query_span'].pop())
+    record_timing("DB", (time.perf_counter() - start_time) * 1000)
+    if _captures:
+        with _captures_lock:
+            for statements in _captures:
+                statements.append(statement)
+
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(context):
+    # after_cursor_execute never runs for a failed statement
+    conn = context.connection
+    if conn is not None and conn.info.get('query_start'):
+        conn.info['query_start'].pop()
+        tracer.end_span(conn.info['query_span'].pop(), context.original_exception)
+
+
+@event.listens_for(Session, "before_commit")
+def _before_commit(session):
+    # the span covers the flush and the COMMIT itself, the flushed statements nest under it
+    session.info['commit_span'] = tracer.start_span("DBCommit")
+
+
+@event.listens_for(Session, "after_commit")
+def _after_commit(session):
+    tracer.end_span(session.info.pop('commit_span', None))
+
+
+@event.listens_for(Session, "after_rollback")
+def _after_rollback(session):
+    started = session.info.pop('commit_span', None)
+    if started is not None:
+        tracer.end_span(started, error="rolled back")
+
+
+def finish_request_queries():
+    queries = g.pop('sql_queries', 0)
+    route = route_metric_name(request.endpoint)
+    if not route or not queries:
+        return
+    log_count(f"{route}DB.queries", queries)
+    if query_budget and queries > query_budget:
+        logger.warning("%s %s ran %d SQL statements, over the budget of %d",
+                       request.method, request.path, queries, query_budget)
@@ -0,0 +1,147 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from flask import g, request
+import json
+import logging
+import threading
+import time
+import uuid
+
+_current_span = ContextVar('current_span', default=None)
+
+trace_logger = logging.getLogger('webapp.trace')
+
+
+class Span:
+    def __init__(self, name, trace_id, parent=None, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent = parent
+        self.attributes = dict(attributes or {})
+        self.error = None
+        self.start = time.time()
+        self._start_counter = time.perf_counter()
+        self.duration_ms = None
+        # every span of a trace shares the root's list, exported together when the root ends
+        self.spans = parent.spans if parent else []
+
+    def finish(self, error=None):
+        self.duration_ms = (time.perf_counter() - self._start_counter) * 1000
+        if error is not None:
+            self.error = error if isinstance(error, str) else repr(error)
+        self.spans.append(self)
+
+    def to_dict(self):
+        entry = {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent.span_id if self.parent else None,
+            'name': self.name,
+            'start': self.start,
+            'duration_ms': round(self.duration_ms, 3),
+        }
+        if self.attributes:
+            entry['attributes'] = self.attributes
+        if self.error:
+            entry['error'] = self.error
+        return entry
+
+
+class JsonFileExporter:
+    """Appends one JSON line per trace to a local file, for tests and local debugging."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, trace_id, spans):
+        line = json.dumps({'trace_id': trace_id, 'spans': spans}, default=str)
+        with self._lock, open(self.path, 'a') as trace_file:
+            trace_file.write(line + '\n')
+
+
+class LogExporter:
+    """Hands traces to the queued log pipeline, so exporting never blocks on disk."""
+
+    def export(self, trace_id, spans):
+        trace_logger.info("trace %s", trace_id, extra={'fields': {'trace_id': trace_id, 'spans': spans}})
+
+
+def exporter_from_config(value):
+    # "log", "file:/tmp/traces.jsonl", or empty to turn tracing off
+    if not value:
+        return None
+    if value == 'log':
+        return LogExporter()
+    if value.startswith('file:'):
+        return JsonFileExporter(value[len('file:'):])
+    raise ValueError(f"Unknown TRACE_EXPORTER {value!r}")
+
+
+class Tracer:
+    def __init__(self):
+        self.exporter = None
+
+    def init_app(self, app):
+        self.exporter = exporter_from_config(app.config.get('TRACE_EXPORTER'))
+
+    def start_span(self, name, trace_id=None, **attributes):
+        """Open a span under the current one, or a new root when trace_id is given.
+
+        Returns (span, token) for end_span, or None when there is nothing to attach it to.
+        """
+        if self.exporter is None:
+            return None
+        parent = _current_span.get()
+        if parent is None and trace_id is None:
+            return None
+        span = Span(name, parent.trace_id if parent else trace_id, parent, attributes)
+        return span, _current_span.set(span)
+
+    def end_span(self, started, error=None):
+        if started is None:
+            return
+        span, token = started
+        span.finish(error)
+        _current_span.reset(token)
+        if span.parent is None and self.exporter is not None:
+            try:
+                self.exporter.export(span.trace_id, [entry.to_dict() for entry in span.spans])
+            except Exception:
+                trace_logger.exception("Exporting trace %s failed", span.trace_id)
+
+    def start_request(self):
+        # the request id doubles as the trace id, so traces and log records join up
+        g.trace_span = self.start_span(f"{request.method} {request.endpoint}", trace_id=g.get('request_id'),
+                                       path=request.path)
+
+    def finish_request(self, status_code=None):
+        started = g.pop('trace_span', None)
+        if started is not None:
+            started[0].attributes['status'] = status_code
+        self.end_span(started)
+
+    @contextmanager
+    def span(self, name, **attributes):
+        started = self.start_span(name, **attributes)
+        try:
+            yield started[0] if started else None
+        except BaseException as e:
+            self.end_span(started, e)
+            raise
+        self.end_span(started)
+
+    @contextmanager
+    def trace(self, name, trace_id=None, **attributes):
+        """Root span for work outside a request, such as a background job."""
+        started = self.start_span(name, trace_id=trace_id or uuid.uuid4().hex, **attributes)
+        try:
+            yield started[0] if started else None
+        except BaseException as e:
+            self.end_span(started, e)
+            raise
+        self.end_span(started)
+
+
+tracer = Tracer()
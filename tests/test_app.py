@@ -7,6 +7,7 @@ import sys
 import pytest
 import json
 import base64
+import uuid
 from unittest.mock import patch, MagicMock
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
@@ -118,3 +119,1039 @@ def test_unauthorized_access(client):
     response = client.get('/v1/user/self')
     assert response.status_code == 401
     assert b"Authentication required!" in response.data
+
+
+def create_verified_user(client, email="test@example.com", password="password123"):
+    payload = {
+        "email": email,
+        "password": password,
+        "first_name": "Test",
+        "last_name": "User"
+    }
+    client.post('/v1/user', data=json.dumps(payload), content_type='application/json')
+    with app.app_context():
+        user = db.session.query(User).filter_by(email=email).first()
+        token = user.verification_token
+    client.get(f"/v1/user/verify?token={token}")
+
+
+def basic_auth(email, password):
+    auth_string = f'{email}:{password}'
+    return {
+        'Authorization': 'Basic ' + base64.b64encode(auth_string.encode('utf-8')).decode('utf-8')
+    }
+
+
+def test_credential_cache_skips_bcrypt(client):
+    """Test repeat requests are served from the verified-credential cache."""
+    create_verified_user(client)
+    headers = basic_auth('test@example.com', 'password123')
+    assert client.get('/v1/user/self', headers=headers).status_code == 200
+
+    with patch('src.auth.check_password') as mock_check_password:
+        response = client.get('/v1/user/self', headers=headers)
+        assert response.status_code == 200
+        mock_check_password.assert_not_called()
+
+    wrong_headers = basic_auth('test@example.com', 'wrong-password')
+    assert client.get('/v1/user/self', headers=wrong_headers).status_code == 401
+
+
+def test_password_change_invalidates_cached_credentials(client):
+    """Test the old password stops working after update_user changes it."""
+    create_verified_user(client)
+    headers = basic_auth('test@example.com', 'password123')
+    assert client.get('/v1/user/self', headers=headers).status_code == 200
+
+    response = client.put('/v1/user/self', data=json.dumps({"password": "new-password"}),
+                          content_type='application/json', headers=headers)
+    assert response.status_code == 204
+
+    assert client.get('/v1/user/self', headers=headers).status_code == 401
+    assert client.get('/v1/user/self', headers=basic_auth('test@example.com', 'new-password')).status_code == 200
+
+
+def test_create_user_hash_pool_full(client):
+    """Test registration fails fast with 503 when the hashing queue is full."""
+    from src.hashing import HashPoolUnavailable
+    payload = {
+        "email": "test@example.com",
+        "password": "password123",
+        "first_name": "Test",
+        "last_name": "User"
+    }
+    with patch('app.hash_password', side_effect=HashPoolUnavailable()):
+        response = client.post('/v1/user', data=json.dumps(payload), content_type='application/json')
+    assert response.status_code == 503
+
+
+def test_profile_pic_upload_and_get(client):
+    """Test the authenticated user and their picture are resolved by token_required."""
+    import io
+    create_verified_user(client)
+    headers = basic_auth('test@example.com', 'password123')
+
+    response = client.get('/v1/user/self/pic', headers=headers)
+    assert response.status_code == 404
+
+    with patch('app.upload_file_to_s3', return_value=True), patch('app.delete_file_from_s3', return_value=True):
+        response = client.post('/v1/user/self/pic', headers=headers, content_type='multipart/form-data',
+                               data={'profilePic': (io.BytesIO(b'fake image'), 'avatar.png')})
+        assert response.status_code == 201
+        first_id = json.loads(response.data)['id']
+
+        response = client.post('/v1/user/self/pic', headers=headers, content_type='multipart/form-data',
+                               data={'profilePic': (io.BytesIO(b'other image'), 'avatar.jpg')})
+        assert response.status_code == 201
+
+    response = client.get('/v1/user/self/pic', headers=headers)
+    assert response.status_code == 200
+    data = json.loads(response.data)
+    assert data['id'] != first_id
+    assert data['file_name'] == 'avatar.jpg'
+
+    with patch('app.delete_file_from_s3', return_value=True):
+        assert client.delete('/v1/user/self/pic', headers=headers).status_code == 204
+    assert client.get('/v1/user/self/pic', headers=headers).status_code == 404
+
+
+def test_healthz_reports_circuit_state(client):
+    """Test /healthz answers from the circuit breaker and keeps 503 when the DB is down."""
+    from sqlalchemy.exc import OperationalError
+    from src.db_health import db_breaker
+    response = client.get('/healthz')
+    assert response.status_code == 200
+    assert response.headers['X-DB-Circuit'] == 'closed'
+
+    for _ in range(db_breaker.failure_threshold):
+        db_breaker.record_failure()
+    try:
+        assert db_breaker.state == 'open'
+        assert client.get('/healthz').status_code == 503
+        assert client.get('/v1/user/self', headers=basic_auth('a@b.com', 'x')).status_code == 503
+
+        # deep mode probes the database directly, which closes the circuit again
+        response = client.get('/healthz', headers={'X-Health-Check': 'deep'})
+        assert response.status_code == 200
+        assert response.headers['X-DB-Circuit'] == 'closed'
+
+        # a deadlock is a 500 for that request only, the circuit stays closed
+        create_verified_user(client)
+        headers = basic_auth('test@example.com', 'password123')
+        deadlock = OperationalError('UPDATE users', {}, Exception(1213, 'Deadlock found'))
+        with patch.object(db.session, 'commit', side_effect=deadlock):
+            assert client.put('/v1/user/self', data=json.dumps({"first_name": "D"}), content_type='application/json',
+                              headers=headers).status_code == 500
+        assert db_breaker.state == 'closed'
+        assert client.get('/healthz').status_code == 200
+
+        # when the primary fails its probe the error counts, and enough of them open the circuit
+        def failed_probe():
+            db_breaker.record_failure()
+            return False
+        with patch.object(db_breaker, 'probe', side_effect=failed_probe), \
+                patch.object(db.session, 'commit', side_effect=OperationalError('UPDATE', {}, Exception(2013, 'Lost'))):
+            statuses = [client.put('/v1/user/self', data=json.dumps({"first_name": "D"}),
+                                   content_type='application/json', headers=headers).status_code
+                        for _ in range(db_breaker.failure_threshold)]
+        assert statuses == [503] * db_breaker.failure_threshold
+        assert db_breaker.state == 'open'
+    finally:
+        db_breaker.record_success()
+
+
+def test_circuit_breaker_half_open_trial():
+    """Test an open circuit lets a single trial probe through after the reset timeout."""
+    from src.db_health import DBCircuitBreaker
+    breaker = DBCircuitBreaker(failure_threshold=2, reset_timeout=0)
+    breaker.record_failure()
+    assert breaker.state == 'closed'
+    breaker.record_failure()
+    assert breaker.state == 'open'
+
+    def failing_probe():
+        assert breaker.state == 'half-open'
+        assert breaker.allow_request() is False
+        breaker.record_failure()
+        return False
+
+    def passing_probe():
+        breaker.record_success()
+        return True
+
+    with patch.object(breaker, 'probe', side_effect=failing_probe):
+        assert breaker.allow_request() is False
+    assert breaker.state == 'open'
+    with patch.object(breaker, 'probe', side_effect=passing_probe):
+        assert breaker.allow_request() is True
+    assert breaker.state == 'closed'
+
+
+class StubSNS:
+    """In-process stand-in for the SNS client used by the outbox dispatcher."""
+
+    def __init__(self, fail_ids=()):
+        self.batches = []
+        self.fail_ids = set(fail_ids)
+
+    def publish_batch(self, TopicArn, PublishBatchRequestEntries):
+        self.batches.append(PublishBatchRequestEntries)
+        successful = [{'Id': e['Id'], 'MessageId': f"msg-{e['Id']}"}
+                      for e in PublishBatchRequestEntries if e['Id'] not in self.fail_ids]
+        failed = [{'Id': e['Id'], 'Code': 'InternalError', 'SenderFault': False}
+                  for e in PublishBatchRequestEntries if e['Id'] in self.fail_ids]
+        return {'Successful': successful, 'Failed': failed}
+
+
+def test_verification_email_outbox(client):
+    """Test registration writes an outbox row that the dispatcher publishes in batches."""
+    from src.models import EmailOutbox
+    from src.sns_operations import OutboxDispatcher
+    for i in range(12):
+        payload = {
+            "email": f"user{i}@example.com",
+            "password": "password123",
+            "first_name": "Test",
+            "last_name": "User"
+        }
+        response = client.post('/v1/user', data=json.dumps(payload), content_type='application/json')
+        assert response.status_code == 201
+
+    stub = StubSNS(fail_ids={'1'})
+    dispatcher = OutboxDispatcher(max_attempts=2, backoff_base=0)
+    dispatcher.init_app(app, client=stub)
+    assert dispatcher.drain() == 10
+    assert dispatcher.drain() == 3
+    assert [len(batch) for batch in stub.batches] == [10, 3]
+    assert json.loads(stub.batches[0][1]['Message'])['email'] == 'user1@example.com'
+
+    with app.app_context():
+        remaining = EmailOutbox.query.all()
+        assert [(m.id, m.status, m.attempts) for m in remaining] == [(1, 'failed', 2)]
+
+
+def test_presigned_profile_pic_upload(client):
+    """Test the presign and complete flow records the image after a HEAD check."""
+    create_verified_user(client)
+    headers = basic_auth('test@example.com', 'password123')
+
+    with patch('app.s3_client') as mock_s3:
+        mock_s3.generate_presigned_post.return_value = {
+            'url': 'https://test-bucket.s3.amazonaws.com/',
+            'fields': {'key': 'ignored', 'Content-Type': 'image/png'}
+        }
+        response = client.post('/v1/user/self/pic/presign', headers=headers,
+                               data=json.dumps({'content_type': 'image/gif'}), content_type='application/json')
+        assert response.status_code == 400
+
+        response = client.post('/v1/user/self/pic/presign', headers=headers,
+                               data=json.dumps({'content_type': 'image/png'}), content_type='application/json')
+        assert response.status_code == 200
+        key = json.loads(response.data)['key']
+        assert key.endswith('.png')
+        conditions = mock_s3.generate_presigned_post.call_args.kwargs['Conditions']
+        assert ['content-length-range', 1, 5 * 1024 * 1024] in conditions
+
+        # only keys presign issues are accepted, not other users' objects or this user's renditions
+        prefix, name = key.split('/')
+        for bad_key in ('someone-else/x.png', f"{prefix}/{name[:-4]}_thumbnail.png", f"{prefix}/x.png"):
+            response = client.post('/v1/user/self/pic/complete', headers=headers,
+                                   data=json.dumps({'key': bad_key}), content_type='application/json')
+            assert response.status_code == 400
+        mock_s3.head_object.assert_not_called()
+
+        mock_s3.head_object.return_value = {'ContentType': 'image/png', 'ContentLength': 1024}
+        response = client.post('/v1/user/self/pic/complete', headers=headers,
+                               data=json.dumps({'key': key, 'file_name': 'me.png'}), content_type='application/json')
+        assert response.status_code == 201
+        mock_s3.head_object.assert_called_with(Bucket='test-bucket', Key=key)
+
+    response = client.get('/v1/user/self/pic', headers=headers)
+    data = json.loads(response.data)
+    assert data['file_name'] == 'me.png'
+    assert data['url'] == f"test-bucket/{key}"
+
+    # a failed swap leaves the current picture and its object alone
+    from sqlalchemy.exc import OperationalError
+    from src.db_health import db_breaker
+    with patch('app.s3_client') as mock_s3, \
+            patch.object(db.session, 'commit', side_effect=OperationalError('COMMIT', {}, Exception('gone'))):
+        mock_s3.head_object.return_value = {'ContentType': 'image/png', 'ContentLength': 1024}
+        response = client.post('/v1/user/self/pic/complete', headers=headers, content_type='application/json',
+                               data=json.dumps({'key': f"{key.rsplit('/', 1)[0]}/{uuid.uuid4()}.png"}))
+        assert response.status_code == 500
+        mock_s3.delete_object.assert_not_called()
+    db_breaker.record_success()
+    assert json.loads(client.get('/v1/user/self/pic', headers=headers).data)['url'] == f"test-bucket/{key}"
+
+
+def test_profile_pic_raw_body_streams_to_s3(client):
+    """Test a raw image body is handed to S3 as the request stream, with early size limits."""
+    create_verified_user(client)
+    headers = basic_auth('test@example.com', 'password123')
+
+    with patch('app.s3_client') as mock_s3:
+        uploaded = {}
+        mock_s3.upload_fileobj.side_effect = lambda fileobj, bucket, key, **kwargs: uploaded.update(
+            body=fileobj.read(), key=key, extra=kwargs['ExtraArgs'])
+        response = client.post('/v1/user/self/pic', headers={**headers, 'X-File-Name': 'me.png'},
+                               data=b'\x89PNG raw bytes', content_type='image/png')
+        assert response.status_code == 201
+        assert uploaded['body'] == b'\x89PNG raw bytes'
+        assert uploaded['key'].endswith('.png')
+        assert uploaded['extra'] == {'ContentType': 'image/png'}
+        assert json.loads(response.data)['file_name'] == 'me.png'
+
+    max_content_length = app.config['MAX_CONTENT_LENGTH']
+    app.config['MAX_CONTENT_LENGTH'] = 16
+    try:
+        response = client.post('/v1/user/self/pic', headers=headers, data=b'x' * 17, content_type='image/png')
+        assert response.status_code == 413
+    finally:
+        app.config['MAX_CONTENT_LENGTH'] = max_content_length
+
+
+def test_image_variants_rendered_and_listed(client):
+    """Test the variant pipeline stores renditions next to the original and lists them."""
+    import io
+    from PIL import Image as PILImage
+    from src.image_variants import VariantPipeline
+
+    create_verified_user(client)
+    headers = basic_auth('test@example.com', 'password123')
+    with patch('app.upload_file_to_s3', return_value=True):
+        response = client.post('/v1/user/self/pic', headers=headers, content_type='multipart/form-data',
+                               data={'profilePic': (io.BytesIO(b'fake image'), 'avatar.png')})
+    image = json.loads(response.data)
+    object_name = image['url'].split('/', 1)[1]
+
+    original = io.BytesIO()
+    PILImage.new('RGB', (800, 400), 'red').save(original, format='PNG')
+    s3 = MagicMock()
+    s3.get_object.return_value = {'Body': io.BytesIO(original.getvalue())}
+
+    pipeline = VariantPipeline(sizes={'thumbnail': 64, 'medium': 256})
+    pipeline.init_app(app, lambda: s3)
+    assert pipeline.process(image['id'], 'test-bucket', object_name) == ['thumbnail', 'medium']
+
+    stored = {call.kwargs['Key']: call.kwargs['Body'] for call in s3.put_object.call_args_list}
+    thumbnail_key = object_name.replace('.png', '_thumbnail.png')
+    assert PILImage.open(stored[thumbnail_key]).size == (64, 32)
+
+    response = client.get('/v1/user/self/pic', headers=headers)
+    variants = json.loads(response.data)['variants']
+    assert variants == {
+        'thumbnail': f"test-bucket/{thumbnail_key}",
+        'medium': f"test-bucket/{object_name.replace('.png', '_medium.png')}"
+    }
+
+    with patch('app.delete_file_from_s3', return_value=True) as mock_delete:
+        assert client.delete('/v1/user/self/pic', headers=headers).status_code == 204
+    assert mock_delete.call_count == 3
+
+
+def test_reset_after_fork_discards_per_process_state(client):
+    """Test the gunicorn post_fork hook drops executors inherited from the master."""
+    from src import hashing
+    from app import reset_after_fork
+    from src.image_variants import variant_pipeline
+    with app.app_context():
+        hashing.hash_password('password123')
+    assert hashing._executor is not None
+    # children come from the fork server, never from a fork of this threaded process
+    assert hashing._executor._mp_context.get_start_method() == 'forkserver'
+    inherited = hashing._executor
+
+    reset_after_fork()
+    assert hashing._executor is None
+    assert variant_pipeline._executor is None
+    inherited.shutdown()
+
+
+def test_instrumented_pool_reports_usage(tmp_path):
+    """Test the pool reports checkout wait, connections in use and overflow."""
+    from sqlalchemy import create_engine, text
+    from src.db_pool import engine_options
+    engine = create_engine(f"sqlite:///{tmp_path / 'pool.db'}", **engine_options(
+        pool_size=1, max_overflow=1, pool_timeout=1, pool_recycle=60, pool_pre_ping=False))
+    with patch('src.db_pool.log_gauge') as mock_gauge, patch('src.db_pool.log_api_call_duration') as mock_timing:
+        with engine.connect() as first, engine.connect() as second:
+            first.execute(text('SELECT 1'))
+            second.execute(text('SELECT 1'))
+            assert [call.args for call in mock_gauge.call_args_list[-2:]] == [
+                ("DBPool.in_use", 2), ("DBPool.overflow", 1)
+            ]
+        assert mock_timing.call_args_list[0].args[0] == "DBPool.checkout_wait"
+        assert mock_gauge.call_args_list[-2].args == ("DBPool.in_use", 0)
+    engine.dispose()
+
+
+def test_read_replica_routing_with_stickiness(client):
+    """Test read-only routes use a replica, except right after the client wrote."""
+    from sqlalchemy import create_engine
+    from sqlalchemy.pool import StaticPool
+    from src.db_routing import primary_stickiness
+    create_verified_user(client)
+    headers = basic_auth('test@example.com', 'password123')
+
+    # an empty replica that has not caught up yet
+    replica = create_engine('sqlite://', poolclass=StaticPool)
+    db.metadata.create_all(replica)
+    with app.app_context():
+        engines = db.engines
+        engines['replica_0'] = replica
+    primary_stickiness._until.clear()
+    client.delete_cookie('db_primary_until')
+    try:
+        assert client.get('/v1/user/self', headers=headers).status_code == 404
+
+        response = client.put('/v1/user/self', data=json.dumps({"first_name": "New"}),
+                              content_type='application/json', headers=headers)
+        assert response.status_code == 204
+        assert 'db_primary_until' in response.headers['Set-Cookie']
+
+        response = client.get('/v1/user/self', headers=headers)
+        assert response.status_code == 200
+        assert json.loads(response.data)['first_name'] == 'New'
+    finally:
+        del engines['replica_0']
+        replica.dispose()
+        primary_stickiness._until.clear()
+
+
+def test_request_metrics_flushed_once(client):
+    """Test each request buffers its metrics, DB sub-timing included, and flushes them once."""
+    from src.metrics import route_sample_rates
+    create_verified_user(client)
+    with patch('src.metrics.statsd_client') as mock_statsd:
+        pipeline = mock_statsd.pipeline.return_value
+        route_sample_rates['GetUserInfo'] = 0.5
+        try:
+            response = client.get('/v1/user/self', headers=basic_auth('test@example.com', 'password123'))
+        finally:
+            route_sample_rates.clear()
+        assert response.status_code == 200
+
+        pipeline.send.assert_called_once()
+        pipeline.incr.assert_any_call("GetUserInfo.count", rate=0.5)
+        pipeline.incr.assert_any_call("GetUserInfo.status.200", rate=0.5)
+        timings = [call.args[0] for call in pipeline.timing.call_args_list]
+        assert "GetUserInfo.duration" in timings
+        assert "GetUserInfoDB.duration" in timings
+        mock_statsd.incr.assert_not_called()
+        mock_statsd.timing.assert_not_called()
+
+
+def test_profiler_writes_collapsed_stacks_for_slow_requests(client, tmp_path):
+    """Test an authenticated X-Profile header samples a slow request into collapsed stacks."""
+    import time
+    from src.profiler import profiler
+    output = tmp_path / 'profile.folded'
+    payload = {
+        "email": "test@example.com",
+        "password": "password123",
+        "first_name": "Test",
+        "last_name": "User"
+    }
+
+    def slow_hash(password):
+        time.sleep(0.1)
+        return b'$2b$04$' + b'x' * 53
+
+    with patch.object(profiler, 'token', 'secret'), patch.object(profiler, 'threshold_ms', 20), \
+            patch.object(profiler, 'output_path', str(output)), patch('app.hash_password', side_effect=slow_hash):
+        client.post('/v1/user', data=json.dumps(payload), content_type='application/json',
+                    headers={'X-Profile': 'wrong'})
+        assert not output.exists()
+
+        payload['email'] = 'other@example.com'
+        response = client.post('/v1/user', data=json.dumps(payload), content_type='application/json',
+                               headers={'X-Profile': 'secret'})
+        assert response.status_code == 201
+
+    lines = output.read_text().splitlines()
+    assert lines
+    stack, count = lines[0].rsplit(' ', 1)
+    assert stack.startswith('POST /v1/user;')
+    assert 'create_user (app.py:' in stack
+    assert int(count) >= 1
+
+    # with nothing left to profile the sampler parks instead of waking every interval
+    deadline = time.time() + 1
+    while profiler._wake.is_set() and time.time() < deadline:
+        time.sleep(0.01)
+    assert not profiler._wake.is_set()
+
+
+def test_query_counts_per_endpoint(client, caplog):
+    """Test statements are counted and route-tagged per request, with a warning over budget."""
+    import io
+    from src import sql_instrumentation
+    from src.sql_instrumentation import capture_queries
+    create_verified_user(client)
+    headers = basic_auth('test@example.com', 'password123')
+
+    with capture_queries() as queries:
+        assert client.get('/v1/user/self', headers=headers).status_code == 200
+    assert len(queries) == 1
+    assert queries[0].endswith('/* route=get_user_info */')
+
+    # a trailing comment would stop PyMySQL rewriting executemany INSERTs into one multi-row statement
+    with app.test_request_context('/v1/user/self'), capture_queries() as queries:
+        db.session.execute(db.text("UPDATE users SET first_name = :name WHERE email = :email"),
+                           [{'name': 'A', 'email': 'a@example.com'}, {'name': 'B', 'email': 'b@example.com'}])
+        db.session.rollback()
+    assert queries and not any('route=' in query for query in queries)
+
+    with capture_queries() as queries:
+        assert client.get('/v1/user/self/pic', headers=headers).status_code == 404
+    assert len(queries) == 1
+
+    with patch.object(sql_instrumentation, 'query_budget', 1), patch('app.upload_file_to_s3', return_value=True):
+        with capture_queries() as queries:
+            response = client.post('/v1/user/self/pic', headers=headers, content_type='multipart/form-data',
+                                   data={'profilePic': (io.BytesIO(b'fake image'), 'avatar.png')})
+        assert response.status_code == 201
+    assert len(queries) == 3
+    assert "POST /v1/user/self/pic ran 3 SQL statements, over the budget of 1" in caplog.text
+
+
+def test_benchmark_regression_check():
+    """Test the benchmark flags throughput, latency and error regressions beyond the tolerance."""
+    from benchmarks.bench_endpoints import compare_results, summarize
+    baseline = [summarize('GET /healthz', [1.0] * 100, 0.1, 0)]
+    assert compare_results([summarize('GET /healthz', [1.1] * 100, 0.11, 0)], baseline, 0.2) == []
+
+    regressions = compare_results([summarize('GET /healthz', [2.0] * 100, 0.2, 1)], baseline, 0.2)
+    assert len(regressions) == 3
+    assert regressions[0] == 'GET /healthz: 500.0 req/s vs baseline 1000.0'
+
+
+def test_migrations_upgrade_legacy_schema(tmp_path):
+    """Test migrations index the token, convert is_verified to boolean and dedupe images."""
+    from sqlalchemy import create_engine, inspect, text
+    from src.migrations import run_migrations, initial_schema
+    engine = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    with engine.begin() as connection:
+        initial_schema(connection)
+        connection.execute(text(
+            "INSERT INTO users (id, email, password, is_verified) VALUES "
+            "('u1', 'a@example.com', 'x', 'True'), ('u2', 'b@example.com', 'x', 'False')"))
+        connection.execute(text(
+            "INSERT INTO images (id, file_name, url, upload_date, user_id) VALUES "
+            "('old', 'a.png', 'b/u1/a.png', '2024-01-01 00:00:00', 'u1'), "
+            "('new', 'b.png', 'b/u1/b.png', '2024-02-01 00:00:00', 'u1')"))
+
+    applied = run_migrations(engine)
+    assert applied == ['initial_schema', 'email_outbox', 'image_variants', 'index_verification_token',
+                       'is_verified_boolean', 'unique_image_user', 'index_token_expiration',
+                       'user_token_version', 'user_account_updated_microseconds', 'outbox_request_id']
+    assert run_migrations(engine) == []
+
+    with engine.connect() as connection:
+        assert connection.execute(text("SELECT id, is_verified FROM users ORDER BY id")).all() == [('u1', 1), ('u2', 0)]
+        assert connection.execute(text("SELECT id FROM images")).scalars().all() == ['new']
+    inspector = inspect(engine)
+    assert 'ix_users_verification_token' in [index['name'] for index in inspector.get_indexes('users')]
+    assert {'name': 'uq_images_user_id', 'unique': 1} in [
+        {'name': index['name'], 'unique': index['unique']} for index in inspector.get_indexes('images')]
+    engine.dispose()
+
+
+def test_migrations_resume_after_partial_ddl(tmp_path):
+    """Test a conversion cut off after its ADD COLUMN, which MySQL has already committed, completes on rerun."""
+    from sqlalchemy import create_engine, text
+    from src.migrations import run_migrations, initial_schema
+    engine = create_engine(f"sqlite:///{tmp_path / 'partial.db'}")
+    with engine.begin() as connection:
+        initial_schema(connection)
+        connection.execute(text(
+            "INSERT INTO users (id, email, password, is_verified) VALUES ('u1', 'a@example.com', 'x', 'True')"))
+        connection.execute(text("ALTER TABLE users ADD COLUMN is_verified_flag BOOLEAN NOT NULL DEFAULT 0"))
+
+    assert 'is_verified_boolean' in run_migrations(engine)
+    with engine.connect() as connection:
+        assert connection.execute(text("SELECT id, is_verified FROM users")).all() == [('u1', 1)]
+    engine.dispose()
+
+
+def test_reaper_removes_expired_unverified_users_in_batches(client):
+    """Test the reaper deletes only expired, unverified users, one committed batch at a time."""
+    from datetime import datetime, timedelta
+    from src.reaper import reap_expired_users
+    create_verified_user(client, email='verified@example.com')
+    with app.app_context():
+        expired = datetime.now() - timedelta(minutes=5)
+        for i in range(5):
+            db.session.add(User(email=f'stale{i}@example.com', password='x', verification_token=f't{i}',
+                                token_expiration=expired))
+        db.session.add(User(email='pending@example.com', password='x', verification_token='fresh',
+                            token_expiration=datetime.now() + timedelta(minutes=2)))
+        db.session.commit()
+
+        with patch('src.reaper.db.session.commit', wraps=db.session.commit) as mock_commit:
+            assert reap_expired_users(batch_size=2, pause_seconds=0) == 5
+            assert mock_commit.call_count == 3
+        remaining = sorted(user.email for user in User.query.all())
+    assert remaining == ['pending@example.com', 'verified@example.com']
+
+
+def test_secrets_are_fetched_once_and_cached_on_disk(tmp_path, monkeypatch):
+    """Test secrets come from the on-disk cache within its TTL, and DB credentials are injected at connect time."""
+    from src import config
+    cache_path = tmp_path / 'secrets.json'
+    monkeypatch.setenv('SECRETS_CACHE_PATH', str(cache_path))
+    monkeypatch.setenv('DB_SECRETS_NAME', 'db-secret')
+    monkeypatch.setattr(config, '_secrets', {})
+    secretsmanager = MagicMock()
+    secretsmanager.get_secret_value.return_value = {'SecretString': json.dumps({'username': 'app', 'password': 'pw'})}
+    with patch('src.config.boto3.client', return_value=secretsmanager):
+        cparams = {}
+        config.inject_db_credentials(None, None, [], cparams)
+        assert cparams == {'user': 'app', 'password': 'pw'}
+        assert oct(cache_path.stat().st_mode & 0o777) == '0o600'
+
+        # a new process reads the file instead of calling Secrets Manager
+        monkeypatch.setattr(config, '_secrets', {})
+        assert config.load_secrets('db-secret') == {'username': 'app', 'password': 'pw'}
+    assert secretsmanager.get_secret_value.call_count == 1
+
+
+def test_conditional_get_returns_304_until_resource_changes(client):
+    """Test If-None-Match is answered with 304 from the version lookup, and a new ETag after changes."""
+    import io
+    create_verified_user(client)
+    headers = basic_auth('test@example.com', 'password123')
+
+    response = client.get('/v1/user/self', headers=headers)
+    etag = response.headers['ETag']
+    with patch('src.auth.User.query') as mock_query:
+        response = client.get('/v1/user/self', headers={**headers, 'If-None-Match': etag})
+        assert response.status_code == 304
+        assert response.data == b''
+        mock_query.options.assert_not_called()
+    assert client.get('/v1/user/self', headers={**basic_auth('test@example.com', 'wrong'),
+                                                'If-None-Match': etag}).status_code == 401
+
+    client.put('/v1/user/self', data=json.dumps({"first_name": "Changed"}), content_type='application/json',
+               headers=headers)
+    response = client.get('/v1/user/self', headers={**headers, 'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    # the version column keeps sub-second precision on MySQL too, updates within a second get new ETags
+    from sqlalchemy.dialects import mysql
+    assert str(User.__table__.c.account_updated.type.compile(dialect=mysql.dialect())) == 'DATETIME(6)'
+
+    with patch('app.upload_file_to_s3', return_value=True):
+        client.post('/v1/user/self/pic', headers=headers, content_type='multipart/form-data',
+                    data={'profilePic': (io.BytesIO(b'fake image'), 'avatar.png')})
+    pic_etag = client.get('/v1/user/self/pic', headers=headers).headers['ETag']
+    assert client.get('/v1/user/self/pic', headers={**headers, 'If-None-Match': pic_etag}).status_code == 304
+    with app.app_context():
+        from src.models import Image, ImageVariant
+        image = Image.query.first()
+        db.session.add(ImageVariant(image_id=image.id, label='thumbnail', url='u', width=64, height=64))
+        db.session.commit()
+    assert client.get('/v1/user/self/pic', headers={**headers, 'If-None-Match': pic_etag}).status_code == 200
+
+
+def test_bulk_import_reports_bad_records_without_aborting(client, tmp_path):
+    """Test NDJSON import inserts valid users in chunks and reports the rest per line."""
+    import bcrypt
+    from datetime import datetime, timedelta
+    from src.models import EmailOutbox
+    create_verified_user(client, email='taken@example.com')
+    legacy_hash = bcrypt.hashpw(b'legacy-pass', bcrypt.gensalt(4)).decode('utf-8')
+    lines = [
+        {"email": "a@example.com", "password": "password-a", "first_name": "A", "last_name": "One"},
+        {"email": "not-an-email", "password": "x", "first_name": "B", "last_name": "Two"},
+        {"email": "legacy@example.com", "password_hash": legacy_hash, "first_name": "L", "last_name": "Three"},
+        {"email": "taken@example.com", "password": "x", "first_name": "T", "last_name": "Four"},
+        {"email": "a@example.com", "password": "again", "first_name": "A", "last_name": "Dup"},
+    ]
+    body = "\n".join(json.dumps(line) for line in lines) + "\n{broken\n"
+
+    assert client.post('/v1/user/import', data=body).status_code == 404
+    app.config['IMPORT_TOKEN'] = 'import-secret'
+    try:
+        assert client.post('/v1/user/import', data=body, headers={'X-Import-Token': 'wrong'}).status_code == 401
+        response = client.post('/v1/user/import?send_verification=false', data=body,
+                               headers={'X-Import-Token': 'import-secret', 'Content-Type': 'application/x-ndjson'})
+    finally:
+        app.config.pop('IMPORT_TOKEN')
+    assert response.status_code == 200
+    report = json.loads(response.data)
+    assert report['imported'] == 2
+    assert [(error['line'], error['error']) for error in report['errors']] == [
+        (2, 'Invalid email address'), (4, 'User already exists'), (5, 'User already exists'), (6, 'Invalid JSON')]
+    with app.app_context():
+        assert User.query.filter_by(email='legacy@example.com').first().verification_token is None
+        assert EmailOutbox.query.count() == 1
+
+    source = tmp_path / 'users.ndjson'
+    source.write_text(json.dumps({"email": "c@example.com", "password": "password-c", "first_name": "C",
+                                  "last_name": "Five"}) + "\n")
+    result = app.test_cli_runner().invoke(args=['import-users', str(source), '--chunk-size', '1'])
+    assert 'Imported 1 user(s), 0 failed' in result.output
+    with app.app_context():
+        imported = User.query.filter_by(email='c@example.com').first()
+        assert imported.verification_token is not None
+        # the sign-up lifetime would let the reaper delete migrated accounts before their email goes out
+        assert imported.token_expiration > datetime.now() + timedelta(days=6)
+        assert EmailOutbox.query.count() == 2
+        assert bcrypt.checkpw(b'password-c', imported.password.encode('utf-8'))
+
+
+def test_bulk_import_over_size_limit_reports_committed_lines(client):
+    """Test a chunked import cut off by MAX_CONTENT_LENGTH returns how far it got instead of a bare 413."""
+    body = "".join(json.dumps({"email": f"user{i}@example.com", "password_hash": '$2b$04$' + 'x' * 53,
+                               "first_name": "U", "last_name": str(i)}) + "\n" for i in range(1, 21))
+    app.config.update(IMPORT_TOKEN='import-secret', IMPORT_CHUNK_SIZE=3)
+    try:
+        with patch.dict(app.config, MAX_CONTENT_LENGTH=len(body) // 2):
+            # gunicorn streams chunked bodies without a Content-Length, so only the stream can enforce the cap
+            response = client.post('/v1/user/import?send_verification=false', data=body,
+                                   headers={'X-Import-Token': 'import-secret', 'Transfer-Encoding': 'chunked'},
+                                   environ_overrides={'wsgi.input_terminated': True})
+    finally:
+        app.config.pop('IMPORT_TOKEN')
+        app.config.pop('IMPORT_CHUNK_SIZE')
+    assert response.status_code == 413
+    report = json.loads(response.data)
+    assert report['imported'] > 0 and report['last_line'] == report['imported']
+    with app.app_context():
+        assert User.query.count() == report['imported']
+        assert User.query.filter_by(email=f"user{report['last_line'] + 1}@example.com").first() is None
+
+
+def test_admission_control_sheds_password_checks_with_429(client, tmp_path):
+    """Test wrong-password floods get 429 before bcrypt, per IP and per account."""
+    from src.rate_limit import admission, SharedTokenBuckets, RateLimited
+    create_verified_user(client)
+    enabled, per_ip, buckets = admission.enabled, admission.per_ip, admission.buckets
+    admission.enabled = True
+    admission.buckets = SharedTokenBuckets(str(tmp_path / 'buckets'), slots=64)
+    try:
+        # cached credentials skip the buckets, so the 429 on the password change below is its own
+        assert client.get('/v1/user/self', headers=basic_auth('test@example.com', 'password123')).status_code == 200
+        wrong = basic_auth('test@example.com', 'wrong-password')
+        statuses = [client.get('/v1/user/self', headers=wrong).status_code for _ in range(admission.account_burst - 1)]
+        assert statuses == [401] * (admission.account_burst - 1)
+        with patch('src.auth.check_password') as mock_check_password:
+            response = client.get('/v1/user/self', headers=wrong)
+            assert response.status_code == 429
+            assert int(response.headers['Retry-After']) >= 1
+            mock_check_password.assert_not_called()
+
+        with patch.object(admission.buckets, 'acquire_slot', return_value=None):
+            payload = {"email": "new@example.com", "password": "password123", "first_name": "N", "last_name": "U"}
+            assert client.post('/v1/user', data=json.dumps(payload), content_type='application/json').status_code == 429
+            # password changes hash too, so they take a slot like any other bcrypt call
+            response = client.put('/v1/user/self', data=json.dumps({"password": "new-password"}),
+                                  content_type='application/json', headers=basic_auth('test@example.com', 'password123'))
+            assert response.status_code == 429
+
+        # without trusted proxies every client arrives from the balancer's address, so there is no per-IP bucket
+        with app.test_request_context(environ_base={'REMOTE_ADDR': '10.0.0.1'}):
+            for i in range(admission.ip_burst + 1):
+                admission.admit(f'other{i}@example.com')
+            admission.per_ip = True
+            with pytest.raises(RateLimited):
+                for i in range(admission.ip_burst + 1):
+                    admission.admit(f'another{i}@example.com')
+    finally:
+        admission.enabled, admission.per_ip, admission.buckets = enabled, per_ip, buckets
+
+
+def test_password_check_slots_are_shared_across_processes(tmp_path):
+    """Test the box-wide cap counts slots held by other processes, and frees them when they exit."""
+    import multiprocessing
+    from src.rate_limit import SharedTokenBuckets
+    path = str(tmp_path / 'buckets')
+    context = multiprocessing.get_context('fork')
+    held, done = context.Event(), context.Event()
+
+    def hold_slot():
+        # kept referenced: closing any fd on the file would drop this process's locks
+        buckets = SharedTokenBuckets(path, slots=8)
+        buckets.acquire_slot(1)
+        held.set()
+        done.wait(5)
+
+    child = context.Process(target=hold_slot)
+    child.start()
+    try:
+        assert held.wait(5)
+        buckets = SharedTokenBuckets(path, slots=8)
+        assert buckets.acquire_slot(1) is None
+        assert buckets.take('ip:1.2.3.4', rate=1, burst=1, now=100) == 0
+        assert buckets.take('ip:1.2.3.4', rate=1, burst=1, now=100.5) == pytest.approx(0.5)
+        # a colliding key shares the drained bucket instead of starting a full one
+        victim_slot = buckets._slot('account:victim@example.com')[1]
+        colliding = next(f'account:{i}@example.com' for i in range(1000)
+                         if buckets._slot(f'account:{i}@example.com')[1] == victim_slot)
+        assert buckets.take('account:victim@example.com', rate=1, burst=1, now=100) == 0
+        assert buckets.take(colliding, rate=1, burst=1, now=100) > 0
+    finally:
+        done.set()
+        child.join(5)
+    assert buckets.acquire_slot(1) == 0
+
+
+def test_structured_logs_carry_request_ids_and_sample_successes():
+    """Test access records are JSON with the request id, and successful requests are sampled per route."""
+    import io
+    import logging
+    from src.log_pipeline import log_pipeline, JsonFormatter
+    stream = io.StringIO()
+    target, rates = log_pipeline.target, log_pipeline.sample_rates
+    log_pipeline.stop()
+    log_pipeline.target = logging.StreamHandler(stream)
+    log_pipeline.target.setFormatter(JsonFormatter())
+    log_pipeline.sample_rates = {'HealthCheck': 0}
+    try:
+        with app.test_client() as test_client:
+            response = test_client.get('/healthz', headers={'X-Request-ID': 'req-123'})
+            assert response.headers['X-Request-ID'] == 'req-123'
+            response = test_client.get('/v1/user/self', headers={'X-Request-ID': 'bad id!'})
+            assert response.status_code == 401
+            generated_id = response.headers['X-Request-ID']
+        log_pipeline.stop()
+    finally:
+        log_pipeline.target, log_pipeline.sample_rates = target, rates
+    records = [json.loads(line) for line in stream.getvalue().splitlines()]
+    access = [record for record in records if record['logger'] == 'webapp.access']
+    assert [(record['request_id'], record['route'], record['status']) for record in access] == [
+        (generated_id, 'GetUserInfo', 401)]
+    assert generated_id != 'bad id!'
+
+
+def test_request_trace_spans_nest_db_and_s3_calls(client, tmp_path):
+    """Test one request exports a trace whose spans form a waterfall under the request id."""
+    import io
+    from src.tracing import tracer, JsonFileExporter
+    create_verified_user(client)
+    headers = basic_auth('test@example.com', 'password123')
+    trace_path = tmp_path / 'traces.jsonl'
+    tracer.exporter = JsonFileExporter(str(trace_path))
+    try:
+        with patch('app.s3_client', MagicMock()):
+            response = client.post('/v1/user/self/pic', headers={**headers, 'X-Request-ID': 'trace-me'},
+                                   content_type='multipart/form-data',
+                                   data={'profilePic': (io.BytesIO(b'fake image'), 'avatar.png')})
+        assert response.status_code == 201
+    finally:
+        tracer.exporter = None
+    traces = [json.loads(line) for line in trace_path.read_text().splitlines()]
+    assert [trace['trace_id'] for trace in traces] == ['trace-me']
+    spans = {span['span_id']: span for span in traces[0]['spans']}
+    root = next(span for span in spans.values() if span['parent_id'] is None)
+    assert root['name'] == 'POST upload_profile_pic' and root['attributes']['status'] == 201
+    by_name = {}
+    for span in spans.values():
+        by_name.setdefault(span['name'], []).append(span)
+    assert by_name['S3Upload'][0]['parent_id'] == root['span_id']
+    assert by_name['S3Upload'][0]['attributes']['key'].endswith('.png')
+    commit = by_name['DBCommit'][0]
+    assert commit['parent_id'] == root['span_id']
+    assert any(span['parent_id'] == commit['span_id'] and span['attributes']['statement'].startswith('INSERT')
+               for span in by_name['DBQuery'])
+
+
+def test_background_sns_and_variant_work_joins_the_request_trace(client, tmp_path):
+    """Test the outbox publish and variant rendering are traced under the request that queued them."""
+    import io
+    from PIL import Image as PILImage
+    from src.image_variants import VariantPipeline
+    from src.sns_operations import OutboxDispatcher
+    from src.tracing import tracer, JsonFileExporter
+    trace_path = tmp_path / 'traces.jsonl'
+    payload = {"email": "signup@example.com", "password": "password123", "first_name": "S", "last_name": "U"}
+    assert client.post('/v1/user', data=json.dumps(payload), content_type='application/json',
+                       headers={'X-Request-ID': 'signup-1'}).status_code == 201
+
+    original = io.BytesIO()
+    PILImage.new('RGB', (80, 40), 'red').save(original, format='PNG')
+    s3 = MagicMock()
+    s3.get_object.return_value = {'Body': io.BytesIO(original.getvalue())}
+    pipeline = VariantPipeline(sizes={'thumbnail': 16})
+    pipeline.init_app(app, lambda: s3)
+
+    tracer.exporter = JsonFileExporter(str(trace_path))
+    try:
+        dispatcher = OutboxDispatcher()
+        dispatcher.init_app(app, client=StubSNS())
+        assert dispatcher.drain() == 1
+        pipeline.process('missing-image', 'test-bucket', 'u/pic.png', 'upload-1')
+    finally:
+        tracer.exporter = None
+    traces = {trace['trace_id']: trace['spans'] for trace in map(json.loads, trace_path.read_text().splitlines())}
+    for trace_id, root_name, child_names in (('signup-1', 'SNSOutboxDrain', {'SNSPublishBatch', 'DBCommit'}),
+                                             ('upload-1', 'ImageVariants', {'S3Get', 'S3Put', 'S3Delete'})):
+        root = next(span for span in traces[trace_id] if span['parent_id'] is None)
+        assert root['name'] == root_name
+        assert child_names <= {span['name'] for span in traces[trace_id] if span['parent_id'] == root['span_id']}
+
+
+def test_cpu_and_disk_work_leave_the_gevent_hub():
+    """Test variant rendering and the log writer run on OS threads under gevent, not as greenlets."""
+    import subprocess
+    script = """
+from gevent import monkey; monkey.patch_all()
+import gevent, io, logging, threading, time
+from src.cooperative import run_in_os_thread
+from src.log_pipeline import log_pipeline, JsonFormatter
+ticks = []
+def tick():
+    for _ in range(10):
+        ticks.append(time.perf_counter())
+        gevent.sleep(0.01)
+def spin():
+    end = time.perf_counter() + 0.2
+    while time.perf_counter() < end:
+        pass
+ticker = gevent.spawn(tick)
+run_in_os_thread(spin)
+ticker.join()
+assert max(b - a for a, b in zip(ticks, ticks[1:])) < 0.1
+stream = io.StringIO()
+log_pipeline.target = logging.StreamHandler(stream)
+log_pipeline.target.setFormatter(JsonFormatter())
+log_pipeline.queue().put_nowait(logging.LogRecord('webapp', logging.INFO, 'app.py', 1, 'written', None, None))
+assert type(log_pipeline._listener).__name__ == 'OsThreadQueueListener'
+log_pipeline.stop()
+assert 'written' in stream.getvalue()
+print('ok')
+"""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run([sys.executable, '-c', script], cwd=root, capture_output=True, text=True, timeout=60)
+    assert result.stdout.strip() == 'ok', result.stderr
+
+
+def test_profiler_samples_greenlets_under_gevent(tmp_path):
+    """Test a slow request greenlet is sampled, its id is not an OS thread in sys._current_frames()."""
+    import subprocess
+    output = tmp_path / 'profile.folded'
+    script = f"""
+from gevent import monkey; monkey.patch_all()
+import gevent
+from flask import Flask
+from src.profiler import profiler
+app = Flask('profiled')
+profiler.enabled, profiler.threshold_ms, profiler.output_path = True, 10, {str(output)!r}
+def wait_on_io():
+    gevent.sleep(0.2)
+with app.test_request_context('/slow'):
+    profiler.start_request()
+    wait_on_io()
+    profiler.finish_request()
+print('ok')
+"""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run([sys.executable, '-c', script], cwd=root, capture_output=True, text=True, timeout=60)
+    assert result.stdout.strip() == 'ok', result.stderr
+    assert 'wait_on_io (<string>:' in output.read_text()
+
+
+def test_failed_upload_keeps_existing_picture(client):
+    """Test the new picture is uploaded before the old one is touched, so a failed upload changes nothing."""
+    import io
+    create_verified_user(client)
+    headers = basic_auth('test@example.com', 'password123')
+    with patch('app.upload_file_to_s3', return_value=True):
+        first = json.loads(client.post('/v1/user/self/pic', headers=headers, content_type='multipart/form-data',
+                                       data={'profilePic': (io.BytesIO(b'one'), 'one.png')}).data)
+
+    with patch('app.upload_file_to_s3', return_value=False), patch('app.delete_file_from_s3') as mock_delete:
+        response = client.post('/v1/user/self/pic', headers=headers, content_type='multipart/form-data',
+                               data={'profilePic': (io.BytesIO(b'two'), 'two.png')})
+        assert response.status_code == 500
+        mock_delete.assert_not_called()
+    assert json.loads(client.get('/v1/user/self/pic', headers=headers).data)['id'] == first['id']
+
+    with patch('app.upload_file_to_s3', return_value=True), patch('app.delete_file_from_s3') as mock_delete:
+        client.post('/v1/user/self/pic', headers=headers, content_type='multipart/form-data',
+                    data={'profilePic': (io.BytesIO(b'three'), 'three.png')})
+    mock_delete.assert_called_once_with('test-bucket', first['url'].split('/', 1)[1])
+
+
+def test_bearer_tokens_skip_bcrypt_rotate_and_revoke_on_password_change(client):
+    """Test login issues a signed bearer token, keys rotate, and a password change revokes old tokens."""
+    from src import auth
+    from src.auth import TokenSigner
+    create_verified_user(client)
+    signer = auth.token_signer
+    auth.token_signer = TokenSigner({'old': 'old-secret'}, ttl_seconds=60)
+    try:
+        response = client.post('/v1/user/self/token', headers=basic_auth('test@example.com', 'password123'))
+        assert response.status_code == 201
+        old_token = json.loads(response.data)['token']
+
+        # rotation: a new key signs, tokens from the previous key still verify
+        auth.token_signer = TokenSigner({'new': 'new-secret', 'old': 'old-secret'}, ttl_seconds=60)
+        token = json.loads(client.post('/v1/user/self/token',
+                                       headers=basic_auth('test@example.com', 'password123')).data)['token']
+        assert token.startswith('new.')
+        bearer = {'Authorization': f'Bearer {token}'}
+        with patch('src.auth.check_password') as mock_check_password:
+            response = client.get('/v1/user/self', headers=bearer)
+            assert response.status_code == 200
+            assert client.get('/v1/user/self', headers={'Authorization': f'Bearer {old_token}'}).status_code == 200
+            assert client.get('/v1/user/self', headers={**bearer, 'If-None-Match': response.headers['ETag']}).status_code == 304
+            mock_check_password.assert_not_called()
+
+        kid, claims, signature = token.split('.')
+        forged = f"{kid}.{claims}.{'A' * len(signature)}"
+        assert client.get('/v1/user/self', headers={'Authorization': f'Bearer {forged}'}).status_code == 401
+        assert client.post('/v1/user/self/token', headers=bearer).status_code == 401
+
+        assert client.put('/v1/user/self', data=json.dumps({"password": "new-password"}),
+                          content_type='application/json', headers=bearer).status_code == 204
+        assert client.get('/v1/user/self', headers=bearer).status_code == 401
+        assert client.get('/v1/user/self', headers={**bearer, 'If-None-Match': response.headers['ETag']}).status_code == 401
+    finally:
+        auth.token_signer = signer
+
+
+def test_token_signer_rejects_expired_and_unknown_keys():
+    """Test expiry and unknown key ids are rejected."""
+    from src.auth import TokenSigner, parse_token_keys
+    signer = TokenSigner(parse_token_keys('k2:second,k1:first'), ttl_seconds=60)
+    token, expires_at = signer.issue('user-1', 3, now=1000)
+    assert signer.verify(token, now=1030) == {'sub': 'user-1', 'ver': 3, 'exp': expires_at}
+    assert signer.verify(token, now=1060) is None
+    assert TokenSigner({'k1': 'first'}).verify(token, now=1030) is None
+    assert signer.verify('not-a-token') is None
+
+
+def test_bearer_tokens_disabled_without_shared_keys(client):
+    """Test no per-process fallback key is made up when AUTH_TOKEN_KEYS is empty."""
+    from src import auth
+    from src.auth import TokenSigner
+    create_verified_user(client)
+    signer = auth.token_signer
+    auth.token_signer = TokenSigner({})
+    try:
+        assert client.post('/v1/user/self/token',
+                           headers=basic_auth('test@example.com', 'password123')).status_code == 503
+        forged = TokenSigner({'local': 'guess'}).issue('user-1', 0)[0]
+        assert client.get('/v1/user/self', headers={'Authorization': f'Bearer {forged}'}).status_code == 401
+    finally:
+        auth.token_signer = signer
+
+
+def test_primary_stickiness_keys_bearer_clients_by_subject():
+    """Test bearer clients behind one proxy address are not pinned to the primary by each other's writes."""
+    from src import auth
+    from src.auth import TokenSigner
+    from src.db_routing import client_identity
+    signer = auth.token_signer
+    auth.token_signer = TokenSigner({'k1': 'secret'}, ttl_seconds=60)
+    try:
+        token = auth.token_signer.issue('user-1', 0)[0]
+        with app.test_request_context(headers={'Authorization': f'Bearer {token}'}, environ_base={'REMOTE_ADDR': '10.0.0.1'}):
+            assert client_identity() == 'user:user-1'
+        with app.test_request_context(headers={'Authorization': 'Bearer forged'}, environ_base={'REMOTE_ADDR': '10.0.0.1'}):
+            assert client_identity() == '10.0.0.1'
+    finally:
+        auth.token_signer = signer
@@ -0,0 +1,4 @@
+# production entry point: gunicorn --config gunicorn.conf.py wsgi:app
+from app import app, reset_after_fork
+
+__all__ = ["app", "reset_after_fork"]